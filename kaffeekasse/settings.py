@@ -21,7 +21,7 @@ ALLOWED_HOSTS = []
 # Application definition
 
 INSTALLED_APPS = [
-    'store',
+    'store.apps.StoreConfig',
     'django.contrib.admin',
     'django.contrib.auth',
     'django.contrib.contenttypes',
@@ -31,6 +31,10 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # First to measure the whole request
+    'store.metrics.MetricsMiddleware',
+    # Pin browsers to the primary database after changes
+    'store.replica.ReplicaMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -72,9 +76,18 @@ DATABASES = {
         'OPTIONS': {
             'isolation_level': psycopg2.extensions.ISOLATION_LEVEL_SERIALIZABLE,
             },
-    }
+    },
+    # Read replica, see REPLICA_DATABASE in store/config.py
+    # 'replica': {
+    #     'ENGINE': 'django.db.backends.postgresql',
+    #     'NAME': 'kaffeekassedb',
+    #     'HOST': 'replica.example.org',
+    #     'USER': getpass.getuser(),
+    # },
 }
 
+DATABASE_ROUTERS = ['store.replica.ReplicaRouter']
+
 
 # Password validation
 # https://docs.djangoproject.com/en/2.2/ref/settings/#auth-password-validators
@@ -133,5 +146,9 @@ LOGGING = {
             'handlers': ['console'],
             'level': 'INFO',
         },
+        'store': {
+            'handlers': ['console'],
+            'level': 'INFO',
+        },
     },
 }
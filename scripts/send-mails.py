@@ -5,66 +5,139 @@
 # Send mails to all active users with purchases since the last run.
 
 
+import argparse
 import os
 import sys
-
-import smtplib
-from email.message import EmailMessage
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 sys.path.append('../')
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'kaffeekasse.settings')
 import django
 django.setup()
 
-from django.db import transaction
-from django.db.models import Count, Sum
+from django.db import connection, transaction
+from django.db.models import Count, F, Sum
 from django.utils import timezone
 
 import store.models as models
 import store.notify as notify
+import store.retry as retry
+
+
+parser = argparse.ArgumentParser(description='Send the monthly bill to all users.')
+parser.add_argument('--dry-run', action='store_true',
+                    help="don't store or send anything, only report the time "
+                         "spent in each phase")
+parser.add_argument('--workers', type=int, default=4,
+                    help='number of parallel SMTP connections (default: 4)')
+args = parser.parse_args()
+
+
+def group_by(rows, key):
+    result = defaultdict(list)
+    for row in rows:
+        result[row.pop(key)].append(row)
+    return result
 
 
-for user in models.UserData.objects.all().order_by('pk'):
-    notification = None
-    with transaction.atomic():
-        # Fetch current version inside transaction
-        user = models.UserData.objects.get(id=user.id)
-
-        last_mail = user.last_mail
-        user.last_mail = timezone.now()
-        user.save()
-
-        purchases = models.Purchase.objects \
-                .filter(user=user,
-                        time_stamp__gte=last_mail,
-                        time_stamp__lt=user.last_mail,
-                        annulled=False) \
-                .values('product__name') \
-                .annotate(count=Count('product__name'), sum=Sum('price'))
-
-        charges   = models.Charge.objects \
-                .filter(user=user,
-                        time_stamp__gte=last_mail,
-                        time_stamp__lt=user.last_mail,
-                        annulled=False) \
-                .annotate(count=Count('comment'), sum=Sum('amount'))
-
-        outgoing = models.Transfer.objects \
-                .filter(sender=user,
-                        time_stamp__gte=last_mail,
-                        time_stamp__lt=user.last_mail,
-                        annulled=False) \
-                .annotate(count=Count('receiver'), sum=Sum('amount'))
-
-        incoming = models.Transfer.objects \
-                .filter(receiver=user,
-                        time_stamp__gte=last_mail,
-                        time_stamp__lt=user.last_mail,
-                        annulled=False) \
-                .annotate(count=Count('sender'), sum=Sum('amount'))
-
-        notification = notify.Bill(user, "Monatsabrechnung", purchases, charges, outgoing, incoming)
+def send(_):
     try:
-        notification.execute()
-    except:
-        pass
+        with notify.Mailer() as mailer:
+            while notify.send_queued_mails(mailer):
+                pass
+    finally:
+        connection.close()
+
+
+phases = []
+def phase(name, start):
+    phases.append((name, time.monotonic() - start))
+    return time.monotonic()
+
+
+def bill():
+    phases.clear()
+    start = time.monotonic()
+
+    # The period of each user starts at the user's last bill and ends now
+    now = timezone.now()
+    # Locked (in the order of UserLogic.lockUsers()) so concurrent purchases
+    # wait until the bills are queued instead of aborting the run
+    users = models.UserData.objects.select_related('auth') \
+            .select_for_update(no_key=True, of=('self',)) \
+            .order_by('pk')
+    users = list(users)
+    # Lower bound for all periods so the time_stamp indexes can be used
+    since = min((x.last_mail for x in users), default=now)
+
+    # Aggregate the activity of all users with one query per kind
+    purchases = group_by(models.Purchase.objects \
+            .filter(time_stamp__gte=F('user__last_mail')) \
+            .filter(time_stamp__gte=since,
+                    time_stamp__lt=now,
+                    annulled=False) \
+            .values('user_id', 'product__name') \
+            .annotate(count=Count('id'), sum=Sum('price')) \
+            .order_by('user_id', 'product__name'), 'user_id')
+
+    charges = group_by(models.Charge.objects \
+            .filter(time_stamp__gte=F('user__last_mail')) \
+            .filter(time_stamp__gte=since,
+                    time_stamp__lt=now,
+                    annulled=False) \
+            .values('user_id', 'comment') \
+            .annotate(count=Count('id'), sum=Sum('amount')) \
+            .order_by('user_id', 'comment'), 'user_id')
+
+    outgoing = group_by(models.Transfer.objects \
+            .filter(time_stamp__gte=F('sender__last_mail')) \
+            .filter(time_stamp__gte=since,
+                    time_stamp__lt=now,
+                    annulled=False) \
+            .values('sender_id', 'receiver__auth__username') \
+            .annotate(count=Count('id'), sum=Sum('amount')) \
+            .order_by('sender_id', 'receiver__auth__username'), 'sender_id')
+
+    incoming = group_by(models.Transfer.objects \
+            .filter(time_stamp__gte=F('receiver__last_mail')) \
+            .filter(time_stamp__gte=since,
+                    time_stamp__lt=now,
+                    annulled=False) \
+            .values('receiver_id', 'sender__auth__username') \
+            .annotate(count=Count('id'), sum=Sum('amount')) \
+            .order_by('receiver_id', 'sender__auth__username'), 'receiver_id')
+    start = phase('aggregate', start)
+
+    mails = []
+    for user in users:
+        notification = notify.Bill(user, "Monatsabrechnung",
+                purchases.get(user.id, []), charges.get(user.id, []),
+                outgoing.get(user.id, []), incoming.get(user.id, []))
+        mail = notification.compose()
+        if mail is not None:
+            mails.append(mail)
+    start = phase('render', start)
+
+    # Queue all bills and advance the period in the same transaction so no
+    # bill is lost or sent twice
+    models.OutgoingMail.objects.bulk_create(mails)
+    models.UserData.objects.filter(last_mail__lt=now).update(last_mail=now)
+    phase('store', start)
+
+    if args.dry_run:
+        transaction.set_rollback(True)
+    return users, mails
+
+
+# The users are locked, READ COMMITTED is enough
+users, mails = retry.atomic('bill', bill, read_committed=True)
+
+if not args.dry_run:
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        list(executor.map(send, range(args.workers)))
+else:
+    print(f'{len(users)} users, {len(mails)} bills')
+    for name, duration in phases:
+        print(f'{name:10} {duration:8.3f} s')
@@ -3,12 +3,27 @@
 import django.contrib.auth.admin
 import django.contrib.auth.models
 import django.urls
+from django import forms
 from django.contrib import admin
-from django.db import transaction
+from django.contrib.admin.views.main import ChangeList
+from django.core.paginator import Paginator
+from django.db import connection, transaction
+from django.db.models import Q
+from django.http import HttpResponseRedirect, StreamingHttpResponse
+from django.template.response import TemplateResponse
+from django.utils import timezone
+from django.utils.functional import cached_property
+from django.utils.html import format_html
+from django.utils.http import urlencode
 from django.utils.translation import gettext_lazy as _
 
+import store.backend as backend
+import store.config as config
+import store.export as export
 import store.models as models
 import store.notify as notify
+import store.replica as replica
+import store.retry as retry
 
 
 def is_delete_for_different_object(admin, request):
@@ -34,6 +49,151 @@ def is_delete_for_different_object(admin, request):
     return True
 
 
+def export_response(queryset, format):
+    lines, content_type = export.FORMATS[format]
+    response = StreamingHttpResponse(lines(queryset), content_type=content_type)
+    response['Content-Disposition'] = 'attachment; filename="{}-{}.{}"'.format(
+        queryset.model._meta.model_name,
+        timezone.localtime().strftime('%Y%m%d-%H%M%S'),
+        format)
+    return response
+
+def export_csv(modeladmin, request, queryset):
+    return export_response(queryset, 'csv')
+export_csv.short_description = _('Export selected as CSV')
+
+def export_ndjson(modeladmin, request, queryset):
+    return export_response(queryset, 'ndjson')
+export_ndjson.short_description = _('Export selected as NDJSON')
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Use PostgreSQL's estimated number of rows instead of an exact (and slow)
+    COUNT(*) for unfiltered lists of large tables.
+    """
+
+    @cached_property
+    def count(self):
+        if not self.object_list.query.where:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT reltuples FROM pg_class WHERE oid = %s::regclass',
+                               [self.object_list.model._meta.db_table])
+                estimate = cursor.fetchone()[0]
+            if estimate > config.ADMIN_ESTIMATED_COUNT_MIN:
+                return int(estimate)
+        return super().count
+
+
+# Query parameter which marks lists whose date was chosen (by the redirect to
+# the default month or the links of the date hierarchy which keep it); only
+# lists without it are redirected, so "All dates" shows the whole table
+DATE_CHOSEN_VAR = 'dated'
+
+
+class TransactionChangeList(ChangeList):
+    def get_filters_params(self, params=None):
+        # Not a lookup
+        lookup_params = super().get_filters_params(params)
+        lookup_params.pop(DATE_CHOSEN_VAR, None)
+        return lookup_params
+
+
+class TransactionModelAdmin(admin.ModelAdmin):
+    """
+    Changelist for the transaction tables which grow forever.
+
+    The search doesn't join the users and products but looks them up in
+    their (small) tables first, then the transactions are found via the
+    indexes on the foreign keys. The lists are read from the replica (if
+    configured) and start at the month of default_month().
+    """
+
+    date_hierarchy = 'time_stamp'
+    paginator = EstimatedCountPaginator
+    # Skip the COUNT(*) of the whole table when filtering
+    show_full_result_count = False
+
+    # Names of the foreign keys to users and products which are searched and
+    # whether the comment is searched
+    search_users = ()
+    search_products = ()
+    search_comment = False
+
+    def get_changelist(self, request, **kwargs):
+        return TransactionChangeList
+
+    def default_month(self):
+        """
+        Return a time in the month the list starts at, None to start
+        unfiltered.
+        """
+
+        return timezone.localtime()
+
+    def changelist_view(self, request, extra_context=None):
+        # Actions (POST) might change the selected transactions
+        if request.method != 'GET':
+            return super().changelist_view(request, extra_context)
+        with replica.readonly():
+            # Start at the default month; the date hierarchy of the whole
+            # table (distinct years) can't be answered from the index
+            field = self.date_hierarchy + '__'
+            if DATE_CHOSEN_VAR not in request.GET \
+                    and not any(x.startswith(field) for x in request.GET):
+                month = self.default_month()
+                if month is not None:
+                    params = request.GET.copy()
+                    params[DATE_CHOSEN_VAR] = '1'
+                    params[field + 'year'] = month.year
+                    params[field + 'month'] = month.month
+                    return HttpResponseRedirect('?' + params.urlencode())
+
+            response = super().changelist_view(request, extra_context)
+            # The list and the date hierarchy are queried while rendering
+            if isinstance(response, TemplateResponse):
+                response.render()
+            return response
+
+    def get_search_results(self, request, queryset, search_term):
+        # Like Django: all terms must match, each in any field
+        for term in search_term.split():
+            user_ids = list(models.UserData.objects.filter(
+                    Q(auth__username__icontains=term) |
+                    Q(auth__first_name__icontains=term) |
+                    Q(auth__last_name__icontains=term) |
+                    Q(auth__email__icontains=term) |
+                    Q(idm__icontains=term)).values_list('id', flat=True))
+            product_ids = []
+            if self.search_products:
+                product_ids = list(models.Product.objects
+                        .filter(name__icontains=term).values_list('id', flat=True))
+
+            q = Q()
+            for x in self.search_users:
+                q |= Q(**{x + '__in': user_ids})
+            for x in self.search_products:
+                q |= Q(**{x + '__in': product_ids})
+            # Not indexed, but charges and transfers are rare compared to
+            # purchases
+            if self.search_comment:
+                q |= Q(comment__icontains=term)
+            queryset = queryset.filter(q)
+        return queryset, False
+
+
+class ArchiveModelAdmin(TransactionModelAdmin):
+    """
+    Changelist for the archive tables which start at the month of the newest
+    archived transaction.
+    """
+
+    def default_month(self):
+        newest = self.model.objects.order_by('-time_stamp') \
+                .values_list('time_stamp', flat=True).first()
+        return timezone.localtime(newest) if newest is not None else None
+
+
 class AppendOnlyModelAdmin(admin.ModelAdmin):
     """
     Disallow changing or deleting the model. Adding new instances is
@@ -47,6 +207,31 @@ class AppendOnlyModelAdmin(admin.ModelAdmin):
             return True
         return False
 
+class RetryModelAdmin(admin.ModelAdmin):
+    """
+    Saving is retried if the transaction conflicts with a concurrent
+    transaction.
+    """
+
+    # See retry.atomic()
+    read_committed = False
+
+    def changeform_view(self, request, *args, **kwargs):
+        # Django's changeform_view() runs in its own transaction which becomes
+        # a savepoint inside the retried transaction
+        view = super().changeform_view
+        name = 'admin:{}'.format(self.model._meta.model_name)
+        return retry.atomic(name, lambda: view(request, *args, **kwargs),
+                            read_committed=self.read_committed)
+
+class MoneyModelAdmin(RetryModelAdmin, AppendOnlyModelAdmin):
+    """
+    Append-only model whose creation moves money. save_model() must lock the
+    users with UserLogic.lockUsers().
+    """
+
+    read_committed = True
+
 class ReadOnlyModelAdmin(AppendOnlyModelAdmin):
     """
     Disallow changing, deleting or adding objects of this model.
@@ -59,6 +244,7 @@ class ReadOnlyModelAdmin(AppendOnlyModelAdmin):
 @admin.register(models.UserData)
 class UserDataAdmin(admin.ModelAdmin):
     list_display = ('username', 'idm', 'money', 'shown_on_login_screen')
+    list_select_related = ('auth',)
     def username(self, obj):
         return obj.auth.username
     username.admin_order_field = 'auth__username'
@@ -87,6 +273,7 @@ class UserDataInline(admin.StackedInline):
 
 class UserAdmin(django.contrib.auth.admin.UserAdmin):
     list_display = ('username', 'idm', 'money', 'first_name', 'last_name', 'email', 'is_staff', 'is_superuser')
+    list_select_related = ('userdata',)
     def idm(self, obj):
         return obj.userdata.idm
     idm.admin_order_field = 'userdata__idm'
@@ -118,6 +305,7 @@ admin.site.register(django.contrib.auth.models.User, UserAdmin)
 @admin.register(models.UserIdentifier)
 class UserIdentifierAdmin(admin.ModelAdmin):
     list_display = ('user', 'ident_type', 'ident')
+    list_select_related = ('user__auth',)
 
     search_fields = ('user__auth__username', 'user__auth__first_name',
                      'user__auth__last_name', 'user__auth__email',
@@ -126,18 +314,82 @@ class UserIdentifierAdmin(admin.ModelAdmin):
 
     autocomplete_fields = ('user',)
 
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        # The identifier is no longer unknown
+        models.UnknownUserIdentifier.objects \
+                .filter(ident_type=obj.ident_type, ident=obj.ident) \
+                .delete()
+
 
 @admin.register(models.UnknownUserIdentifier)
 class UnknownUserIdentifierAdmin(admin.ModelAdmin):
-    list_display = ('time_stamp', 'ident_type', 'ident')
+    list_display = ('ident_type', 'ident', 'hits', 'first_seen', 'last_seen', 'assign')
+    list_filter = ('ident_type',)
+    # Most frequently scanned first, probably a new card of a regular user
+    ordering = ('-hits', '-last_seen')
+
+    search_fields = ('ident',)
+
+    def has_add_permission(self, request):
+        return False
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def assign(self, obj):
+        # Prefilled form to add the identifier to a user
+        url = django.urls.reverse('admin:store_useridentifier_add')
+        return format_html('<a href="{}?{}">{}</a>', url,
+                           urlencode({'ident_type': obj.ident_type, 'ident': obj.ident}),
+                           _('Assign to user'))
+    assign.short_description = _('Assign')
+
+
+class ProductForm(forms.ModelForm):
+    # Current stock when the form was shown; the difference to the entered
+    # stock is recorded as change so concurrent purchases aren't lost
+    shown_stock = forms.IntegerField(widget=forms.HiddenInput)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fields['shown_stock'].initial = self.instance.stock
 
 
 @admin.register(models.Product)
-class ProductAdmin(admin.ModelAdmin):
-    list_display = ('name', 'category', 'price', 'stock')
+class ProductAdmin(RetryModelAdmin):
+    form = ProductForm
+    list_display = ('name', 'category', 'price', 'current_stock')
+    list_select_related = ('category',)
 
     search_fields = ('name',)
 
+    def get_queryset(self, request):
+        return backend.ProductLogic.annotateStock(super().get_queryset(request))
+
+    def current_stock(self, obj):
+        return obj.current_stock
+    current_stock.admin_order_field = 'current_stock'
+    current_stock.short_description = _('Stock')
+
+    def get_object(self, request, object_id, from_field=None):
+        obj = super().get_object(request, object_id, from_field)
+        # Edit the current stock
+        if obj is not None:
+            obj.stock = obj.current_stock
+        return obj
+
+    def save_model(self, request, obj, form, change):
+        if not change:
+            super().save_model(request, obj, form, change)
+            return
+
+        # obj.stock includes the pending changes, keep the stored value
+        obj.save(update_fields=[x for x in form.changed_data
+                                if x not in ('stock', 'shown_stock')])
+        amount = form.cleaned_data['stock'] - form.cleaned_data['shown_stock']
+        if amount != 0:
+            backend.ProductLogic.changeStock(obj.id, amount)
+
 
 @admin.register(models.ProductCategory)
 class ProductCategoryAdmin(admin.ModelAdmin):
@@ -148,6 +400,7 @@ class ProductCategoryAdmin(admin.ModelAdmin):
 @admin.register(models.ProductIdentifier)
 class ProductIdentifierAdmin(admin.ModelAdmin):
     list_display = ('product', 'ident_type', 'ident')
+    list_select_related = ('product',)
 
     search_fields = ('product__name', 'ident')
 
@@ -155,8 +408,9 @@ class ProductIdentifierAdmin(admin.ModelAdmin):
 
 
 @admin.register(models.Charge)
-class ChargeAdmin(AppendOnlyModelAdmin):
+class ChargeAdmin(TransactionModelAdmin, MoneyModelAdmin):
     list_display = ('time_stamp', 'user', 'amount', 'admin', 'comment', 'annulled')
+    list_select_related = ('user__auth', 'admin__auth')
     # "annulled" to prevent enabling it when adding new objects
     readonly_fields = ('time_stamp', 'admin', 'annulled')
 
@@ -164,43 +418,48 @@ class ChargeAdmin(AppendOnlyModelAdmin):
                      'user__auth__last_name', 'user__auth__email',
                      'user__idm',
                      'comment')
+    search_users = ('user',)
+    search_comment = True
 
     autocomplete_fields = ('user',)
 
+    actions = (export_csv, export_ndjson)
+
     def save_model(self, request, obj, form, change):
         assert not change
         assert not obj.annulled
         # TODO: this is hacky and duplicates code from backend.py
         # Update user's money value
         obj.admin = request.user.userdata
-        notification = None
         with transaction.atomic():
-            user = models.UserData.objects.get(id=obj.user.id)
-            user.money += obj.amount
-            user.save()
-            obj.user = user
-            notification = notify.Charge(obj)
-        try:
-            notification.execute()
-        except:
-            pass
-        super().save_model(request, obj, form, change)
+            backend.UserLogic.lockUsers([obj.user.id])
+            super().save_model(request, obj, form, change)
+            backend.UserLogic.changeMoney(obj.user.id, [models.LedgerEntry(
+                kind=models.LedgerEntry.CHARGE, amount=obj.amount, charge=obj)])
+            obj.user = models.UserData.objects.get(id=obj.user.id)
+            notify.Charge(obj).execute()
 
 
 @admin.register(models.Purchase)
-class PurchaseAdmin(ReadOnlyModelAdmin):
+class PurchaseAdmin(TransactionModelAdmin, ReadOnlyModelAdmin):
     list_display = ('time_stamp', 'user', 'product', 'price', 'annulled')
+    list_select_related = ('user__auth', 'product')
     readonly_fields = ('time_stamp',)
 
     search_fields = ('user__auth__username', 'user__auth__first_name',
                      'user__auth__last_name', 'user__auth__email',
                      'user__idm',
                      'product__name')
+    search_users = ('user',)
+    search_products = ('product',)
+
+    actions = (export_csv, export_ndjson)
 
 
 @admin.register(models.Transfer)
-class TransferAdmin(AppendOnlyModelAdmin):
+class TransferAdmin(TransactionModelAdmin, MoneyModelAdmin):
     list_display = ('time_stamp', 'sender', 'receiver', 'amount', 'admin', 'comment', 'annulled')
+    list_select_related = ('sender__auth', 'receiver__auth', 'admin__auth')
     # "annulled" to prevent enabling it when adding new objects
     readonly_fields = ('time_stamp', 'admin', 'annulled')
 
@@ -211,32 +470,106 @@ class TransferAdmin(AppendOnlyModelAdmin):
                      'receiver__auth__last_name', 'receiver__auth__email',
                      'receiver__idm',
                      'comment')
+    search_users = ('sender', 'receiver')
+    search_comment = True
 
     autocomplete_fields = ('sender', 'receiver')
 
+    actions = (export_csv, export_ndjson)
+
     def save_model(self, request, obj, form, change):
         assert not change
         assert not obj.annulled
         # TODO: this is hacky and duplicates code from backend.py
         # Update users' money value
         obj.admin = request.user.userdata
-        notification = None
         with transaction.atomic():
-            sender = models.UserData.objects.get(id=obj.sender.id)
-            sender.money -= obj.amount
-            sender.save()
-            receiver = models.UserData.objects.get(id=obj.receiver.id)
-            receiver.money += obj.amount
-            receiver.save()
+            backend.UserLogic.lockUsers([obj.sender.id, obj.receiver.id])
+            super().save_model(request, obj, form, change)
+            backend.UserLogic.changeMoney(obj.sender.id, [models.LedgerEntry(
+                kind=models.LedgerEntry.TRANSFER, amount=-obj.amount,
+                transfer=obj)])
+            backend.UserLogic.changeMoney(obj.receiver.id, [models.LedgerEntry(
+                kind=models.LedgerEntry.TRANSFER, amount=obj.amount,
+                transfer=obj)])
             # update users of transfer object for updated money values
-            obj.sender = sender
-            obj.receiver = receiver
-            notification = notify.Transfer(obj)
-        try:
-            notification.execute()
-        except:
-            pass
-        super().save_model(request, obj, form, change)
+            obj.sender = models.UserData.objects.get(id=obj.sender.id)
+            obj.receiver = models.UserData.objects.get(id=obj.receiver.id)
+            notify.Transfer(obj).execute()
+
+
+@admin.register(models.LedgerEntry)
+class LedgerEntryAdmin(TransactionModelAdmin, ReadOnlyModelAdmin):
+    list_display = ('time_stamp', 'user', 'kind', 'amount', 'balance')
+    list_select_related = ('user__auth',)
+    list_filter = ('kind',)
+
+    search_fields = ('user__auth__username', 'user__auth__first_name',
+                     'user__auth__last_name', 'user__auth__email',
+                     'user__idm')
+    search_users = ('user',)
+
+
+@admin.register(models.ArchivedCharge)
+class ArchivedChargeAdmin(ArchiveModelAdmin, ReadOnlyModelAdmin):
+    list_display = ChargeAdmin.list_display
+    list_select_related = ChargeAdmin.list_select_related
+
+    search_fields = ChargeAdmin.search_fields
+    search_users = ChargeAdmin.search_users
+    search_comment = True
+
+    actions = (export_csv, export_ndjson)
+
+
+@admin.register(models.ArchivedPurchase)
+class ArchivedPurchaseAdmin(ArchiveModelAdmin, ReadOnlyModelAdmin):
+    list_display = PurchaseAdmin.list_display
+    list_select_related = PurchaseAdmin.list_select_related
+
+    search_fields = PurchaseAdmin.search_fields
+    search_users = PurchaseAdmin.search_users
+    search_products = PurchaseAdmin.search_products
+
+    actions = (export_csv, export_ndjson)
+
+
+@admin.register(models.ArchivedTransfer)
+class ArchivedTransferAdmin(ArchiveModelAdmin, ReadOnlyModelAdmin):
+    list_display = TransferAdmin.list_display
+    list_select_related = TransferAdmin.list_select_related
+
+    search_fields = TransferAdmin.search_fields
+    search_users = TransferAdmin.search_users
+    search_comment = True
+
+    actions = (export_csv, export_ndjson)
+
+
+@admin.register(models.BalanceCheckpoint)
+class BalanceCheckpointAdmin(ReadOnlyModelAdmin):
+    list_display = ('user', 'time_stamp', 'amount')
+    list_select_related = ('user__auth',)
+
+    search_fields = ('user__auth__username', 'user__auth__first_name',
+                     'user__auth__last_name', 'user__auth__email',
+                     'user__idm')
+
+
+@admin.register(models.OutgoingMail)
+class OutgoingMailAdmin(ReadOnlyModelAdmin):
+    list_display = ('time_stamp', 'recipient', 'subject', 'state', 'attempts', 'last_error')
+    list_filter = ('state',)
+
+    search_fields = ('recipient', 'subject')
+
+    actions = ('requeue',)
+
+    def requeue(self, request, queryset):
+        queryset.filter(state=models.OutgoingMail.FAILED) \
+                .update(state=models.OutgoingMail.QUEUED, attempts=0,
+                        next_attempt=timezone.now())
+    requeue.short_description = _('Queue failed mails again')
 
 
 # We don't use groups, hide it
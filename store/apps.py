@@ -1,7 +1,44 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 
 from django.apps import AppConfig
+from django.db import connections
+from django.db.models.signals import post_migrate
+
+
+# Prefix indexes for the user search (see UserLogic.searchUsers()). The user
+# table belongs to django.contrib.auth, so they can't be declared in a model.
+USER_SEARCH_INDEXES = {
+    'user_search_username': 'username',
+    'user_search_first_name': 'first_name',
+    'user_search_last_name': 'last_name',
+}
+
+
+def create_user_search_indexes(using, **kwargs):
+    import django.contrib.auth.models
+
+    table = django.contrib.auth.models.User._meta.db_table
+    with connections[using].cursor() as cursor:
+        for name, column in USER_SEARCH_INDEXES.items():
+            cursor.execute('CREATE INDEX IF NOT EXISTS {} ON {} '
+                           '(lower({}) text_pattern_ops)'
+                           .format(name, table, column))
+
+
+def create_cache_version_sequence(using, **kwargs):
+    import store.invalidation
+
+    with connections[using].cursor() as cursor:
+        cursor.execute('CREATE SEQUENCE IF NOT EXISTS {}'
+                       .format(store.invalidation.SEQUENCE))
 
 
 class StoreConfig(AppConfig):
     name = 'store'
+
+    def ready(self):
+        # Register the signal handlers which invalidate the caches
+        import store.cache
+
+        post_migrate.connect(create_user_search_indexes, sender=self)
+        post_migrate.connect(create_cache_version_sequence, sender=self)
@@ -1,22 +1,28 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 
-from datetime import timedelta
-from typing import List, Dict, Tuple
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import List, Dict, Optional, Tuple
 from decimal import Decimal
 
 import django.contrib.auth
 import django.contrib.auth.models
-from django.db import transaction
-from django.db.models import F, Count
+from django.db import connection
+from django.db.models import F, OuterRef, Q, QuerySet, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
 from django.http import HttpRequest
 from django.utils import timezone
 
 from typeguard import typechecked
 
+import store.cache as cache
 import store.config as config
 import store.exceptions as exceptions
+import store.metrics as metrics
 import store.models as models
 import store.notify as notify
+import store.replica as replica
+import store.retry as retry
 
 class UserLogic:
     @staticmethod
@@ -29,6 +35,13 @@ class UserLogic:
         if ident_type == models.UserIdentifier.PRIMARYKEY:
             return models.UserData.objects.get(id=ident)
 
+        user_id = cache.user_identifiers.get(ident_type, ident)
+        if user_id is not None:
+            user = models.UserData.objects.filter(id=user_id).first()
+            if user is not None:
+                return user
+
+        generation = cache.user_identifiers.generation
         x = models.UserIdentifier.objects.filter(ident=ident, ident_type=ident_type) \
                 .select_related('user') \
                 .first()
@@ -36,18 +49,31 @@ class UserLogic:
             # Remeber failed RFID/Barcode logins
             if ident_type == models.UserIdentifier.RFID or \
                ident_type == models.UserIdentifier.BARCODE:
-                i = models.UnknownUserIdentifier(ident=ident, ident_type=ident_type)
-                i.save()
-
-            # Expire old entries
-            time_stamp = timezone.now() - timedelta(days=1)
-            models.UnknownUserIdentifier.objects \
-                    .filter(time_stamp__lt=time_stamp) \
-                    .delete()
-
+                UserLogic.recordUnknownIdentifier(ident, ident_type)
+            metrics.inc('failed_lookups', kind='user', ident_type=str(ident_type))
             raise exceptions.UserIdentifierNotExists()
+        cache.user_identifiers.put(ident_type, ident, x.user.id, generation)
         return x.user
 
+    @staticmethod
+    @typechecked
+    def recordUnknownIdentifier(ident: str, ident_type: int) -> None:
+        """
+        Remember the unknown identifier or count another hit of it. Old
+        entries are expired by the "purgeunknownidentifiers" command.
+        """
+
+        def run():
+            now = timezone.now()
+            with connection.cursor() as cursor:
+                cursor.execute('INSERT INTO {0} (ident_type, ident, first_seen, last_seen, hits) '
+                               'VALUES (%s, %s, %s, %s, 1) '
+                               'ON CONFLICT (ident_type, ident) '
+                               'DO UPDATE SET hits = {0}.hits + 1, last_seen = EXCLUDED.last_seen'
+                               .format(models.UnknownUserIdentifier._meta.db_table),
+                               [ident_type, ident, now, now])
+        retry.atomic('recordUnknownIdentifier', run)
+
     @staticmethod
     @typechecked
     def login(request: HttpRequest, ident: str, ident_type: int) -> None:
@@ -64,6 +90,65 @@ class UserLogic:
 
     @staticmethod
     @typechecked
+    def changeMoney(user_id: int, entries: List[models.LedgerEntry]) -> Decimal:
+        """
+        Book the given unsaved ledger entries (with kind, amount and
+        reference set): add their (possibly negative) amounts to the user's
+        money, store them with the running balance and return the new
+        balance. Withdrawals must not let the money drop below the configured
+        limit.
+
+        This is a single UPDATE statement instead of reading, modifying and
+        saving the user to prevent conflicts between concurrent transactions.
+        """
+
+        amount = sum((x.amount for x in entries), Decimal(0))
+        with connection.cursor() as cursor:
+            cursor.execute('UPDATE {} SET money = money + %s '
+                           'WHERE id = %s AND (%s >= 0 OR money + %s >= %s) '
+                           'RETURNING money'.format(models.UserData._meta.db_table),
+                           [amount, user_id, amount, amount, config.MONEY_MIN_LIMIT])
+            row = cursor.fetchone()
+        if row is None:
+            if not models.UserData.objects.filter(id=user_id).exists():
+                raise models.UserData.DoesNotExist()
+            raise exceptions.UserNotEnoughMoney()
+
+        # The user's row is locked by the UPDATE until the end of the
+        # transaction, the entries of each user are therefore written in
+        # order
+        time_stamp = timezone.now()
+        balance = row[0] - amount
+        for x in entries:
+            balance += x.amount
+            x.user_id = user_id
+            x.time_stamp = time_stamp
+            x.balance = balance
+        models.LedgerEntry.objects.bulk_create(entries)
+        return row[0]
+
+    @staticmethod
+    @typechecked
+    def lockUsers(user_ids: List[Optional[int]]) -> None:
+        """
+        Lock the users (before changing their money) until the end of the
+        transaction. All transactions lock users in the order of their ids
+        so transactions changing the same users can't deadlock.
+        """
+
+        # FOR NO KEY UPDATE like the UPDATE in changeMoney() so inserting rows
+        # which reference the users isn't blocked
+        users = models.UserData.objects \
+                .select_for_update(no_key=True) \
+                .filter(id__in=[x for x in user_ids if x is not None]) \
+                .order_by('id') \
+                .values_list('id', flat=True)
+        # The rows are locked when the query is evaluated
+        list(users)
+
+    @staticmethod
+    @replica.readonly()
+    @typechecked
     def getFrequentUsersList() -> List[dict]:
         """
         Return list of users sorted after last login.
@@ -73,9 +158,51 @@ class UserLogic:
 
         x = User.objects.filter(userdata__shown_on_login_screen=True) \
                 .values('username', 'userdata__id') \
-                .order_by(F('last_login').desc(nulls_last=True))
+                .order_by(F('last_login').desc(nulls_last=True))[:config.N_SHOWN_USERS]
         return list(x)
 
+    @staticmethod
+    @typechecked
+    def searchUsers(query: str, user_id: Optional[int] = None) -> List[dict]:
+        """
+        Return users where each word of the query is a prefix of the
+        username, first or last name, sorted after last login (count capped
+        via configuration). Without user_id only users shown on the login
+        screen are searched, otherwise all users except this one.
+        """
+
+        words = query.lower().split()[:3]
+        if not words:
+            return []
+
+        # Uses the lower(...) text_pattern_ops indexes, see apps.py
+        where = []
+        params = {'limit': config.N_USER_SEARCH_RESULTS, 'user': user_id}
+        for i, word in enumerate(words):
+            word = word.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+            params['word{}'.format(i)] = word + '%'
+            where.append('(lower(a.username) LIKE %(word{0})s '
+                         'OR lower(a.first_name) LIKE %(word{0})s '
+                         'OR lower(a.last_name) LIKE %(word{0})s)'.format(i))
+        if user_id is None:
+            where.append('u.shown_on_login_screen')
+        else:
+            where.append('u.id <> %(user)s')
+
+        with connection.cursor() as cursor:
+            cursor.execute('''
+                SELECT u.id, a.username
+                FROM {userdata} AS u
+                JOIN {user} AS a ON a.id = u.auth_id
+                WHERE {where}
+                ORDER BY a.last_login DESC NULLS LAST, a.username
+                LIMIT %(limit)s
+                '''.format(userdata=models.UserData._meta.db_table,
+                           user=django.contrib.auth.models.User._meta.db_table,
+                           where=' AND '.join(where)),
+                params)
+            return [{'id': x, 'username': y} for x, y in cursor.fetchall()]
+
 
 class ProductLogic:
     @staticmethod
@@ -89,17 +216,110 @@ class ProductLogic:
             try:
                 return models.Product.objects.get(id=ident)
             except models.Product.DoesNotExist:
+                metrics.inc('failed_lookups', kind='product', ident_type=str(ident_type))
                 raise exceptions.ProductIdentifierNotExists()
 
+        product_id = cache.product_identifiers.get(ident_type, ident)
+        if product_id is not None:
+            product = models.Product.objects.filter(id=product_id).first()
+            if product is not None:
+                return product
+
+        generation = cache.product_identifiers.generation
         x = models.ProductIdentifier.objects.filter(ident_type=ident_type).filter(ident=ident) \
                 .select_related('product') \
                 .first()
         if x is None:
+            metrics.inc('failed_lookups', kind='product', ident_type=str(ident_type))
             raise exceptions.ProductIdentifierNotExists()
+        cache.product_identifiers.put(ident_type, ident, x.product.id, generation)
         return x.product
 
     @staticmethod
     @typechecked
+    def getProductsByIdents(idents: List[Tuple[str, int]]) -> List[models.Product]:
+        """
+        Return the products given by the list of identifiers and their types
+        (in the same order). Uses one query per identifier type instead of
+        one per identifier.
+        """
+
+        product_ids = {}
+        missing: Dict[int, List[str]] = {}
+        for ident, ident_type in idents:
+            if ident_type == models.ProductIdentifier.PRIMARYKEY:
+                try:
+                    product_ids[(ident, ident_type)] = int(ident)
+                except ValueError:
+                    metrics.inc('failed_lookups', kind='product', ident_type=str(ident_type))
+                    raise exceptions.ProductIdentifierNotExists()
+                continue
+
+            product_id = cache.product_identifiers.get(ident_type, ident)
+            if product_id is None:
+                missing.setdefault(ident_type, []).append(ident)
+            else:
+                product_ids[(ident, ident_type)] = product_id
+
+        generation = cache.product_identifiers.generation
+        for ident_type, x in missing.items():
+            found = models.ProductIdentifier.objects \
+                    .filter(ident_type=ident_type, ident__in=x) \
+                    .values_list('ident', 'product_id')
+            for ident, product_id in found:
+                product_ids[(ident, ident_type)] = product_id
+                cache.product_identifiers.put(ident_type, ident, product_id, generation)
+
+        products = models.Product.objects.in_bulk(set(product_ids.values()))
+        result = []
+        for x in idents:
+            product = products.get(product_ids.get(x))
+            if product is None:
+                metrics.inc('failed_lookups', kind='product', ident_type=str(x[1]))
+                raise exceptions.ProductIdentifierNotExists()
+            result.append(product)
+        return result
+
+    @staticmethod
+    @typechecked
+    def changeStock(product_id: int, amount: int) -> None:
+        """
+        Add the (possibly negative) amount to the product's stock.
+        """
+
+        ProductLogic.changeStocks({product_id: amount})
+
+    @staticmethod
+    @typechecked
+    def changeStocks(amounts: Dict[int, int]) -> None:
+        """
+        Add the (possibly negative) amounts to the stock of the products
+        (indexed by product id) with a single query. The changes are only
+        recorded, concurrent purchases of the same product don't conflict.
+        """
+
+        models.StockChange.objects.bulk_create(
+                [models.StockChange(product_id=x, amount=y) for x, y in amounts.items()])
+
+    @staticmethod
+    @typechecked
+    def annotateStock(queryset: QuerySet) -> QuerySet:
+        """
+        Annotate the products of the queryset with their current stock
+        ("current_stock") including the pending changes.
+        """
+
+        pending = models.StockChange.objects \
+                .filter(product=OuterRef('pk')) \
+                .values('product') \
+                .annotate(sum=Sum('amount')) \
+                .values('sum')
+        return queryset.annotate(current_stock=F('stock') +
+                                 Coalesce(Subquery(pending), Value(0)))
+
+    @staticmethod
+    @replica.readonly()
+    @typechecked
     def getMostBoughtProductsList(user_id: int) -> List[dict]:
         """
         Return list of products most often bought (time and count
@@ -109,19 +329,19 @@ class ProductLogic:
         max_products = config.N_MOST_BOUGHT_PRODUCTS
         max_days = config.T_MOST_BOUGHT_PRODUCTS_D
 
-        time_stamp = timezone.now() - timedelta(days=max_days)
-        products = models.Purchase.objects \
-                .filter(user=user_id,
-                        time_stamp__gte=time_stamp,
-                        product__isnull=False,
-                        annulled=False) \
-                .select_related('product') \
+        # The counts are per day: today and the max_days - 1 days before,
+        # never more than max_days like the previous cutoff by time stamp
+        day = timezone.localdate() - timedelta(days=max_days)
+        products = models.PurchaseCount.objects \
+                .filter(user=user_id, day__gt=day) \
                 .values('product__name', 'product_id', 'product__price') \
-                .annotate(total=Count('product_id')) \
+                .annotate(total=Sum('count')) \
+                .filter(total__gt=0) \
                 .order_by('-total')[:max_products]
         return list(products)
 
     @staticmethod
+    @replica.readonly()
     @typechecked
     def getLastBoughtProductsList(user_id: int) -> List[dict]:
         """
@@ -151,28 +371,25 @@ class ProductLogic:
         Return all products as dict in the given category.
         """
 
-        # Get sublevels
-        sublevels = models.ProductCategory.objects.filter(toplevel=category).values('sublevel')
+        return cache.catalog.get().categories.get(category, {})
 
-        # Get product
-        products = {}
-        for sublevel in sublevels:
-            # Get product for sublevel
-            sublevel = sublevel['sublevel']
-            ps = models.ProductCategory.objects.filter(toplevel=category, sublevel=sublevel) \
-                    .prefetch_related('products') \
-                    .values('products__id', 'products__name', 'products__price') \
-                    .all()
+    @staticmethod
+    @typechecked
+    def getProducts() -> Dict[int, dict]:
+        """
+        Return all products as dict indexed by their id.
+        """
 
-            # Rename keys
-            for p in ps:
-                p['id'] = p.pop('products__id')
-                p['name'] = p.pop('products__name')
-                p['price'] = p.pop('products__price')
+        return cache.catalog.get().products
 
-            products[sublevel] = list(ps)
+    @staticmethod
+    @typechecked
+    def getCatalog() -> cache.Catalog:
+        """
+        Return the current catalog of all products and categories.
+        """
 
-        return products
+        return cache.catalog.get()
 
     @staticmethod
     @typechecked
@@ -186,6 +403,41 @@ class ProductLogic:
 
 
 class PurchaseLogic:
+    @staticmethod
+    @typechecked
+    def countPurchase(user_id: int, product_id: int, time_stamp: datetime,
+                      count: int) -> None:
+        """
+        Add count (possibly negative) to the number of purchases of the
+        product by the user on the day of time_stamp.
+        """
+
+        PurchaseLogic.countPurchases(user_id, {product_id: count}, time_stamp)
+
+    @staticmethod
+    @typechecked
+    def countPurchases(user_id: int, counts: Dict[int, int],
+                       time_stamp: datetime) -> None:
+        """
+        Like countPurchase() for multiple products (counts is indexed by
+        product id) with a single query.
+        """
+
+        if not counts:
+            return
+        day = timezone.localdate(time_stamp)
+        params = []
+        for product_id, count in counts.items():
+            params.extend([user_id, product_id, day, count])
+        with connection.cursor() as cursor:
+            cursor.execute('INSERT INTO {0} (user_id, product_id, day, count) '
+                           'VALUES {1} '
+                           'ON CONFLICT (user_id, day, product_id) '
+                           'DO UPDATE SET count = {0}.count + EXCLUDED.count'
+                           .format(models.PurchaseCount._meta.db_table,
+                                   ', '.join(['(%s, %s, %s, %s)'] * len(counts))),
+                           params)
+
     @staticmethod
     @typechecked
     def purchase(user_id: int, product_ident: str, product_ident_type: int) \
@@ -195,27 +447,57 @@ class PurchaseLogic:
         and product.
         """
 
-        notification = None
-        with transaction.atomic():
+        def run():
             product = ProductLogic.getProduct(product_ident, product_ident_type)
-            product.stock -= 1
-            product.save()
+            purchase = models.Purchase(user_id=user_id, product=product, price=product.price)
+            purchase.save()
 
-            user = models.UserData.objects.get(id=user_id)
-            user.money -= product.price
-            if user.money < config.MONEY_MIN_LIMIT:
-                raise exceptions.UserNotEnoughMoney()
-            user.save()
+            UserLogic.changeMoney(user_id, [models.LedgerEntry(
+                kind=models.LedgerEntry.PURCHASE, amount=-purchase.price,
+                purchase=purchase)])
+            ProductLogic.changeStock(product.id, -1)
+            PurchaseLogic.countPurchase(user_id, product.id, purchase.time_stamp, 1)
+            notify.Purchase(purchase).execute()
+            return purchase
+        purchase = retry.atomic('purchase', run, read_committed=True)
 
-            purchase = models.Purchase(user=user, product=product, price=product.price)
-            purchase.save()
-            notification = notify.Purchase(purchase)
-        try:
-            notification.execute()
-        except:
-            pass
+        return purchase.id, purchase.product_id
+
+    @staticmethod
+    @typechecked
+    def purchaseMany(user_id: int, products: List[Tuple[str, int]]) \
+            -> List[Tuple[int, int]]:
+        """
+        Purchase all products (given as list of identifier and its type) for
+        the given user in a single transaction; either all or none are
+        purchased. Return id's of purchase and product for each product.
+        """
+
+        if not products:
+            return []
+        if len(products) > config.N_PURCHASE_MANY_PRODUCTS:
+            raise exceptions.TooManyProducts()
 
-        return purchase.id, product.id
+        def run():
+            items = ProductLogic.getProductsByIdents(products)
+            counts = Counter(x.id for x in items)
+
+            purchases = models.Purchase.objects.bulk_create([
+                models.Purchase(user_id=user_id, product=x, price=x.price)
+                for x in items])
+
+            UserLogic.changeMoney(user_id, [models.LedgerEntry(
+                kind=models.LedgerEntry.PURCHASE, amount=-x.price, purchase=x)
+                for x in purchases])
+            ProductLogic.changeStocks({x: -y for x, y in counts.items()})
+            PurchaseLogic.countPurchases(user_id, dict(counts),
+                                         purchases[0].time_stamp)
+            for purchase in purchases:
+                notify.Purchase(purchase).execute()
+            return purchases
+        purchases = retry.atomic('purchaseMany', run, read_committed=True)
+
+        return [(x.id, x.product_id) for x in purchases]
 
     @staticmethod
     @typechecked
@@ -226,31 +508,31 @@ class PurchaseLogic:
 
         annullable_time = config.T_ANNULLABLE_PURCHASE_M
 
-        notification = None
-        with transaction.atomic():
-            purchase = models.Purchase.objects.get(id=purchase_id)
+        def run():
+            # Locked so concurrent annulments can't both succeed
+            purchase = models.Purchase.objects.select_for_update(no_key=True) \
+                    .get(id=purchase_id)
 
             time_limit = timezone.now() - timedelta(minutes=annullable_time)
-            if time_limit >= purchase.time_stamp:
+            if purchase.annulled or time_limit >= purchase.time_stamp:
                 raise exceptions.PurchaseNotAnnullable()
 
-            user = purchase.user
-            user.money += purchase.price
-            user.save()
-            product = purchase.product
-            product.stock += 1
-            product.save()
+            UserLogic.changeMoney(purchase.user_id, [models.LedgerEntry(
+                kind=models.LedgerEntry.PURCHASE_ANNULMENT,
+                amount=purchase.price, purchase=purchase)])
+            if purchase.product_id is not None:
+                ProductLogic.changeStock(purchase.product_id, 1)
+                PurchaseLogic.countPurchase(purchase.user_id, purchase.product_id,
+                                            purchase.time_stamp, -1)
             purchase.annulled = True
             purchase.save()
-            notification = notify.Purchase(purchase)
-        try:
-            notification.execute()
-        except:
-            pass
+            notify.Purchase(purchase).execute()
+        retry.atomic('annulPurchase', run, read_committed=True)
 
 
 class ChargeLogic:
     @staticmethod
+    @replica.readonly()
     @typechecked
     def getLastChargesList(user_id: int) -> List[dict]:
         """
@@ -281,18 +563,14 @@ class ChargeLogic:
 
         assert amount > 0
 
-        notification = None
-        with transaction.atomic():
-            user = models.UserData.objects.get(id=user_id)
-            user.money += amount
-            user.save()
-            charge = models.Charge(amount=amount, user=user)
+        def run():
+            charge = models.Charge(amount=amount, user_id=user_id)
             charge.save()
-            notification = notify.Charge(charge)
-        try:
-            notification.execute()
-        except:
-            pass
+            UserLogic.changeMoney(user_id, [models.LedgerEntry(
+                kind=models.LedgerEntry.CHARGE, amount=amount, charge=charge)])
+            notify.Charge(charge).execute()
+            return charge
+        charge = retry.atomic('charge', run, read_committed=True)
         return charge.id
 
     @staticmethod
@@ -304,26 +582,22 @@ class ChargeLogic:
 
         annullable_time = config.T_ANNULLABLE_CHARGE_M
 
-        notification = None
-        with transaction.atomic():
-            charge = models.Charge.objects.get(id=charge_id)
+        def run():
+            # Locked so concurrent annulments can't both succeed
+            charge = models.Charge.objects.select_for_update(no_key=True) \
+                    .get(id=charge_id)
 
             time_limit = timezone.now() - timedelta(minutes=annullable_time)
-            if time_limit > charge.time_stamp:
+            if charge.annulled or time_limit > charge.time_stamp:
                 raise exceptions.ChargeNotAnnullable()
 
-            user = charge.user
-            user.money -= charge.amount
-            if user.money < config.MONEY_MIN_LIMIT:
-                raise exceptions.UserNotEnoughMoney()
-            user.save()
+            UserLogic.changeMoney(charge.user_id, [models.LedgerEntry(
+                kind=models.LedgerEntry.CHARGE_ANNULMENT, amount=-charge.amount,
+                charge=charge)])
             charge.annulled = True
             charge.save()
-            notification = notify.Charge(charge)
-        try:
-            notification.execute()
-        except:
-            pass
+            notify.Charge(charge).execute()
+        retry.atomic('annulCharge', run, read_committed=True)
 
 class TransferLogic:
     @staticmethod
@@ -332,33 +606,49 @@ class TransferLogic:
         """
         Return list of frequent transfer recipients of this user. First often
         used recipients of the user (count capped via configuration) followed
-        by the remaining users.
+        by the remaining users, at most N_SHOWN_USERS. The result is cached,
+        don't modify it.
         """
 
-        max_receivers = config.N_TRANSFERS_RECEIVERS
-        recent_transfers = models.Transfer.objects.filter(sender=user_id) \
-                .exclude(receiver=None) \
-                .select_related('receiver')
-
-        if max_receivers >= 0:
-            recent_transfers = recent_transfers[:max_receivers]
-
-        other_transfers = models.UserData.objects.exclude(id__in=[d.receiver.id for d in list(recent_transfers)]) \
-                .exclude(id=user_id) \
-                .values('id', username=F('auth__username')) \
-                .order_by('username')
+        result = cache.transfer_targets.get(user_id)
+        if result is not None:
+            return result
 
-        recent_transfers = recent_transfers.values('receiver', receiver__username=F('receiver__auth__username')) \
-                .annotate(total=Count('receiver')) \
-                .order_by('receiver__username').order_by('-total')
-
-        for transfer in recent_transfers:
-            transfer['id'] = transfer.pop('receiver')
-            transfer['username'] = transfer.pop('receiver__username')
+        max_receivers = config.N_TRANSFERS_RECEIVERS
 
-        return list(recent_transfers) + list(other_transfers)
+        generation = cache.transfer_targets.generation
+        # Rank all users by the number of transfers they received from this
+        # user; only the top ranked recipients are sorted by rank, the others
+        # by name
+        with connection.cursor() as cursor:
+            cursor.execute('''
+                SELECT id, username FROM (
+                    SELECT u.id, a.username, t.total,
+                           row_number() OVER (ORDER BY t.total DESC NULLS LAST,
+                                                       a.username) AS rank
+                    FROM {userdata} AS u
+                    JOIN {user} AS a ON a.id = u.auth_id
+                    LEFT JOIN (SELECT receiver_id, count(*) AS total
+                               FROM {transfer}
+                               WHERE sender_id = %(user)s
+                               GROUP BY receiver_id) AS t ON t.receiver_id = u.id
+                    WHERE u.id <> %(user)s) AS x
+                ORDER BY CASE WHEN total IS NOT NULL AND (%(max)s < 0 OR rank <= %(max)s)
+                              THEN rank END,
+                         username
+                LIMIT %(limit)s
+                '''.format(userdata=models.UserData._meta.db_table,
+                           user=django.contrib.auth.models.User._meta.db_table,
+                           transfer=models.Transfer._meta.db_table),
+                {'user': user_id, 'max': max_receivers,
+                 'limit': config.N_SHOWN_USERS})
+            result = [{'id': x, 'username': y} for x, y in cursor.fetchall()]
+
+        cache.transfer_targets.put(user_id, result, generation)
+        return result
 
     @staticmethod
+    @replica.readonly()
     @typechecked
     def getLastTransfers(user_id: int) -> List[dict]:
         """
@@ -384,36 +674,34 @@ class TransferLogic:
     @staticmethod
     @typechecked
     def transfer(user_id: int, receiver_ident: str, receiver_ident_type: int,
-            amount: Decimal) -> Tuple[int, int]:
+            amount: Decimal) -> Tuple[int, int, str]:
         """
-        Transfer money from the given user to the given recipient.
+        Transfer money from the given user to the given recipient. Return the
+        transfer id and the recipient's id and username.
         """
 
         assert amount > 0
 
-        notification = None
-        with transaction.atomic():
-            sender = models.UserData.objects.get(id=user_id)
+        def run():
             receiver = UserLogic.getUser(ident=receiver_ident, ident_type=receiver_ident_type)
-            if sender.id == receiver.id:
+            if user_id == receiver.id:
                 raise exceptions.SenderEqualsReceiverError()
 
-            transfer = models.Transfer(sender=sender, receiver=receiver, amount=amount)
+            UserLogic.lockUsers([user_id, receiver.id])
+            transfer = models.Transfer(sender_id=user_id, receiver_id=receiver.id, amount=amount)
             transfer.save()
 
-            sender.money -= amount
-            if sender.money < config.MONEY_MIN_LIMIT:
-                raise exceptions.UserNotEnoughMoney()
-            sender.save()
-            receiver.money += amount
-            receiver.save()
-            notification = notify.Transfer(transfer)
-        try:
-            notification.execute()
-        except:
-            pass
+            UserLogic.changeMoney(user_id, [models.LedgerEntry(
+                kind=models.LedgerEntry.TRANSFER, amount=-amount,
+                transfer=transfer)])
+            UserLogic.changeMoney(receiver.id, [models.LedgerEntry(
+                kind=models.LedgerEntry.TRANSFER, amount=amount,
+                transfer=transfer)])
+            notify.Transfer(transfer).execute()
+            return transfer
+        transfer = retry.atomic('transfer', run, read_committed=True)
 
-        return transfer.id, receiver.id
+        return transfer.id, transfer.receiver_id, transfer.receiver.auth.username
 
     @staticmethod
     @typechecked
@@ -424,27 +712,61 @@ class TransferLogic:
 
         annullable_time = config.T_ANNULLABLE_TRANSFERS_M
 
-        notification = None
-        with transaction.atomic():
-            transfer = models.Transfer.objects.get(id=transfer_id)
+        def run():
+            # Locked so concurrent annulments can't both succeed
+            transfer = models.Transfer.objects.select_for_update(no_key=True) \
+                    .get(id=transfer_id)
 
             time_limit = timezone.now() - timedelta(minutes=annullable_time)
-            if time_limit > transfer.time_stamp:
+            if transfer.annulled or time_limit > transfer.time_stamp:
                 raise exceptions.TransferNotAnnullable()
 
-            receiver = transfer.receiver
-            sender = transfer.sender
-
+            UserLogic.lockUsers([transfer.sender_id, transfer.receiver_id])
             transfer.annulled = True
             transfer.save()
-            receiver.money -= transfer.amount
-            if receiver.money < config.MONEY_MIN_LIMIT:
-                raise exceptions.UserNotEnoughMoney()
-            receiver.save()
-            sender.money += transfer.amount
-            sender.save()
-            notification = notify.Transfer(transfer)
-        try:
-            notification.execute()
-        except:
-            pass
+            UserLogic.changeMoney(transfer.receiver_id, [models.LedgerEntry(
+                kind=models.LedgerEntry.TRANSFER_ANNULMENT,
+                amount=-transfer.amount, transfer=transfer)])
+            UserLogic.changeMoney(transfer.sender_id, [models.LedgerEntry(
+                kind=models.LedgerEntry.TRANSFER_ANNULMENT,
+                amount=transfer.amount, transfer=transfer)])
+            notify.Transfer(transfer).execute()
+        retry.atomic('annulTransfer', run, read_committed=True)
+
+
+class LedgerLogic:
+    @staticmethod
+    @typechecked
+    def getEntries(user_id: int, before: Optional[Tuple[datetime, int]] = None,
+                   limit: int = config.N_LEDGER_ENTRIES) -> List[dict]:
+        """
+        Return the user's ledger entries, newest first. For the next page pass
+        time stamp and id of the last returned entry as before.
+        """
+
+        entries = models.LedgerEntry.objects.filter(user=user_id)
+        if before is not None:
+            time_stamp, entry_id = before
+            entries = entries.filter(Q(time_stamp__lt=time_stamp) |
+                                     Q(time_stamp=time_stamp, id__lt=entry_id))
+        entries = entries \
+                .values('id', 'time_stamp', 'kind', 'amount', 'balance',
+                        'purchase_id', 'charge_id', 'transfer_id') \
+                .order_by('-time_stamp', '-id')[:limit]
+        return list(entries)
+
+    @staticmethod
+    @typechecked
+    def getBalance(user_id: int, time_stamp: datetime) -> Decimal:
+        """
+        Return the user's money at the given time.
+        """
+
+        entry = models.LedgerEntry.objects \
+                .filter(user=user_id, time_stamp__lte=time_stamp) \
+                .order_by('-time_stamp', '-id') \
+                .values('balance') \
+                .first()
+        if entry is None:
+            return Decimal(0)
+        return entry['balance']
@@ -0,0 +1,279 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# In-process caches for data which is read on every kiosk page view but
+# changes only rarely (via the admin interface). The caches are invalidated
+# via Django's model signals, in the other processes via store/invalidation.py.
+
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, Optional
+
+import django.dispatch
+import django.contrib.auth.models
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+
+import store.config as config
+import store.invalidation as invalidation
+import store.models as models
+
+
+class Catalog:
+    """
+    Immutable snapshot of all products. Don't modify the returned data, it's
+    shared between all requests.
+    """
+
+    def __init__(self, version: int, categories: Dict[int, Dict[str, List[dict]]],
+                 products: Dict[int, dict]):
+        # Version of the catalog this snapshot was built from
+        self.version = version
+        # Toplevel category -> sublevel category -> list of products
+        self.categories = categories
+        # Product id -> product
+        self.products = products
+
+        # Serialized once for the kiosk (see views.catalog())
+        self.json = json.dumps({
+            'categories': {
+                toplevel: [{
+                    'name': sublevel,
+                    'products': [x['id'] for x in prods],
+                } for sublevel, prods in sublevels.items()]
+                for toplevel, sublevels in categories.items()
+            },
+            'products': {
+                x['id']: {
+                    'name': x['name'],
+                    'price': float(x['price']),
+                } for x in products.values()
+            },
+        }, separators=(',', ':')).encode()
+        # The version counter is local to each process, the ETag must be the
+        # same in all processes serving the same catalog
+        self.etag = '"{}"'.format(hashlib.sha1(self.json).hexdigest())
+
+
+class ProductCatalog:
+    """
+    Cache the product catalog (categories and products) which is required
+    for every buy page. The version is incremented on every invalidation so
+    callers can detect changes.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = 0
+        self._catalog: Optional[Catalog] = None
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._version += 1
+            self._catalog = None
+
+    def get(self) -> Catalog:
+        invalidation.start()
+
+        catalog = self._catalog
+        if catalog is not None:
+            return catalog
+
+        version = self._version
+        catalog = self._build(version)
+        with self._lock:
+            # Don't store the catalog if it was invalidated while building
+            # it, it might already be outdated
+            if self._version == version:
+                self._catalog = catalog
+        return catalog
+
+    @staticmethod
+    def _build(version: int) -> Catalog:
+        # Fetch everything in a single query; LEFT JOIN to keep empty
+        # sublevel categories
+        rows = models.ProductCategory.objects \
+                .values('toplevel', 'sublevel',
+                        'products__id', 'products__name', 'products__price') \
+                .order_by('id', 'products__id')
+
+        categories: Dict[int, Dict[str, List[dict]]] = {}
+        products: Dict[int, dict] = {}
+        for row in rows:
+            sublevels = categories.setdefault(row['toplevel'], {})
+            prods = sublevels.setdefault(row['sublevel'], [])
+            if row['products__id'] is None:
+                continue
+
+            product = {
+                'id': row['products__id'],
+                'name': row['products__name'],
+                'price': row['products__price'],
+            }
+            prods.append(product)
+            products[product['id']] = product
+
+        return Catalog(version, categories, products)
+
+
+catalog = ProductCatalog()
+invalidation.register('catalog', lambda key: catalog.invalidate())
+
+
+@django.dispatch.receiver(post_save, sender=models.Product)
+@django.dispatch.receiver(post_delete, sender=models.Product)
+@django.dispatch.receiver(post_save, sender=models.ProductCategory)
+@django.dispatch.receiver(post_delete, sender=models.ProductCategory)
+@django.dispatch.receiver(post_save, sender=models.ProductIdentifier)
+@django.dispatch.receiver(post_delete, sender=models.ProductIdentifier)
+def invalidate_catalog(sender, **kwargs):
+    catalog.invalidate()
+    # Again after the commit, otherwise a concurrent request could store a
+    # catalog built before the commit
+    transaction.on_commit(catalog.invalidate)
+    invalidation.publish('catalog')
+
+
+class LRUCache:
+    """
+    Bounded mapping with least recently used eviction. Don't modify the
+    cached values, they're shared between all requests.
+    """
+
+    def __init__(self, size: int):
+        self._lock = threading.Lock()
+        self._size = size
+        self._entries: 'OrderedDict[Hashable, Any]' = OrderedDict()
+        # Incremented on every invalidation, see put()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable) -> Any:
+        invalidation.start()
+
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: Hashable, value: Any, generation: int) -> None:
+        """
+        Store the value. generation must be read before querying the
+        database; if the cache was invalidated in the meantime the (possibly
+        outdated) value is not stored.
+        """
+
+        if self._size <= 0:
+            return
+        with self._lock:
+            if self.generation != generation:
+                return
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._size:
+                self._entries.popitem(last=False)
+
+    def discard(self, key: Hashable) -> None:
+        with self._lock:
+            self.generation += 1
+            self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+class IdentifierCache(LRUCache):
+    """
+    Mapping of (ident_type, ident) to the primary key of the identified
+    object. Only successful lookups are cached.
+    """
+
+    def get(self, ident_type: int, ident: str) -> Optional[int]:
+        return super().get((ident_type, ident))
+
+    def put(self, ident_type: int, ident: str, pk: int, generation: int) -> None:
+        super().put((ident_type, ident), pk, generation)
+
+
+user_identifiers = IdentifierCache(config.IDENTIFIER_CACHE_SIZE)
+product_identifiers = IdentifierCache(config.IDENTIFIER_CACHE_SIZE)
+invalidation.register('user_identifiers', lambda key: user_identifiers.clear())
+invalidation.register('product_identifiers', lambda key: product_identifiers.clear())
+
+
+@django.dispatch.receiver(post_save, sender=models.UserIdentifier)
+@django.dispatch.receiver(post_delete, sender=models.UserIdentifier)
+def invalidate_user_identifiers(sender, **kwargs):
+    # The identifier might have been changed, the old value is no longer
+    # known; identifiers are changed rarely so drop everything
+    user_identifiers.clear()
+    # Again after the commit, otherwise a concurrent lookup could cache the
+    # old owner of the identifier
+    transaction.on_commit(user_identifiers.clear)
+    invalidation.publish('user_identifiers')
+
+
+@django.dispatch.receiver(post_save, sender=models.ProductIdentifier)
+@django.dispatch.receiver(post_delete, sender=models.ProductIdentifier)
+def invalidate_product_identifiers(sender, **kwargs):
+    product_identifiers.clear()
+    transaction.on_commit(product_identifiers.clear)
+    invalidation.publish('product_identifiers')
+
+
+# Transfer page of each user: frequent recipients followed by all other users
+transfer_targets = LRUCache(config.TRANSFER_TARGETS_CACHE_SIZE)
+
+
+def invalidate_transfer_targets_entry(key: Optional[int]) -> None:
+    if key is None:
+        transfer_targets.clear()
+    else:
+        transfer_targets.discard(key)
+
+invalidation.register('transfer_targets', invalidate_transfer_targets_entry)
+
+
+@django.dispatch.receiver(post_save, sender=models.Transfer)
+@django.dispatch.receiver(post_delete, sender=models.Transfer)
+def invalidate_transfer_targets(sender, instance, **kwargs):
+    # Invalidate after the commit, otherwise a concurrent request could cache
+    # the old ranking again
+    sender_id = instance.sender_id
+    if sender_id is None:
+        return
+    transaction.on_commit(lambda: transfer_targets.discard(sender_id))
+    invalidation.publish('transfer_targets', sender_id)
+
+
+@django.dispatch.receiver(post_save, sender=django.contrib.auth.models.User)
+@django.dispatch.receiver(post_delete, sender=django.contrib.auth.models.User)
+@django.dispatch.receiver(post_save, sender=models.UserData)
+@django.dispatch.receiver(post_delete, sender=models.UserData)
+def invalidate_all_transfer_targets(sender, update_fields=None, **kwargs):
+    # Every login updates last_login, ignore changes which don't affect the
+    # usernames
+    if update_fields is not None and 'username' not in update_fields:
+        return
+    transaction.on_commit(transfer_targets.clear)
+    invalidation.publish('transfer_targets')
@@ -12,6 +12,9 @@ N_MOST_BOUGHT_PRODUCTS = 10
 # Number of days in the past that are used as time intervall limit to search
 # for 'Häufig gekauft'
 T_MOST_BOUGHT_PRODUCTS_D = 30
+# Maximum number of products purchased at once (the cart of the buy page);
+# all of them are locked in one transaction
+N_PURCHASE_MANY_PRODUCTS = 50
 
 # Show charge link and permit users making their own charges
 CHARGE_PERMIT_MANUAL = True
@@ -31,7 +34,107 @@ T_ANNULLABLE_TRANSFERS_M = 60
 N_TRANSFERS_RECEIVERS = -1
 # Number of transfers that should be shown in 'Letzte Überweisungen'
 N_LAST_TRANSFERS = 10
+# Number of users shown on the login screen and as transfer receivers; the
+# other users are found via the search
+N_SHOWN_USERS = 50
+# Maximum number of users returned by the user search
+N_USER_SEARCH_RESULTS = 20
+
+# Number of ledger entries (the combined history of a user) returned per page
+N_LEDGER_ENTRIES = 50
+
+# Number of rows fetched at once when exporting transactions
+EXPORT_CHUNK_SIZE = 2000
+
+# Transactions older than this many days are moved to the archive tables
+# (see the "archive" management command); transactions since the last bill
+# are never archived
+ARCHIVE_AFTER_D = 365
+
+# Admin lists of tables with more rows than this (according to PostgreSQL's
+# statistics) show the estimated instead of the exact number of rows
+ADMIN_ESTIMATED_COUNT_MIN = 100000
 
 # Users cannot purchase products or transfer money if their money gets below
-# this amount
+# this amount. Also enforced by a check constraint, run makemigrations and
+# migrate after changing it.
 MONEY_MIN_LIMIT = 0
+
+# Unknown identifiers of failed logins are kept this many days after their
+# last scan (see the "purgeunknownidentifiers" command)
+T_UNKNOWN_IDENTIFIERS_D = 1
+
+# Interval in seconds in which "compactstock --loop" adds the stock changes of
+# the purchases to the products' stock
+STOCK_COMPACT_INTERVAL_S = 60
+
+# Number of user and product identifiers (RFID, barcode, etc.) cached in memory
+# (per process and per kind) to skip the identifier lookup. 0 disables the
+# cache.
+IDENTIFIER_CACHE_SIZE = 1000
+# Number of users whose list of transfer recipients is cached (per process)
+TRANSFER_TARGETS_CACHE_SIZE = 50
+# Changes are sent to the caches of the other processes with LISTEN/NOTIFY.
+# Interval in seconds in which the caches are checked for missed changes
+# (e.g. while the listening connection is down).
+CACHE_POLL_INTERVAL_S = 5
+
+# Transactions which are aborted because of conflicting concurrent
+# transactions (e.g. two purchases of the same user) are retried this often
+SERIALIZATION_RETRIES = 10
+# Initial maximum delay in milliseconds before retrying; doubled after each
+# retry, the actual delay is chosen randomly between 0 and this value
+SERIALIZATION_RETRY_BACKOFF_MS = 10
+# Maximum time in milliseconds spent waiting for retries of a single operation
+SERIALIZATION_RETRY_BUDGET_MS = 1000
+# Transactions which move money (purchases, charges, transfers and their
+# annulments) lock the affected users in a fixed order and run at READ
+# COMMITTED; concurrent transactions wait for each other instead of being
+# aborted and retried. False runs them at SERIALIZABLE like everything else.
+MONEY_READ_COMMITTED = True
+
+# SMTP server used to send notification mails
+MAIL_SMTP_HOST = 'localhost'
+# Sender address of notification mails
+MAIL_FROM = 'i4kaffee@cs.fau.de'
+# Number of mails the mail worker sends per transaction
+MAIL_BATCH_SIZE = 50
+# Number of attempts to send a mail before giving up (the mail is kept with
+# state "Failed" and can be queued again in the admin interface)
+MAIL_MAX_ATTEMPTS = 10
+# Delay in seconds before the first retry of a failed mail; doubled after
+# each failed attempt
+MAIL_RETRY_DELAY_S = 60
+# Time in seconds the mail worker waits before checking for new mails
+MAIL_POLL_INTERVAL_S = 5
+# Time in seconds a mail worker has to send the mails of a batch; afterwards
+# the unsent mails are sent by another worker (e.g. if this one died). Must be
+# longer than sending MAIL_BATCH_SIZE mails takes.
+MAIL_LEASE_S = 600
+
+# Directory in which each process (WSGI workers, mail worker) stores its
+# metrics, /metrics sums them up. None only shows the metrics of the process
+# serving the request (e.g. the development server).
+METRICS_DIR = None
+# Interval in seconds in which each process writes its metrics to METRICS_DIR
+METRICS_WRITE_INTERVAL_S = 5
+# Bearer token required to read /metrics (e.g. "bearer_token" in the scrape
+# configuration of Prometheus); None disables the endpoint
+METRICS_TOKEN = None
+# Upper bounds of the histogram buckets for durations in seconds
+METRICS_DURATION_BUCKETS_S = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5]
+# Upper bounds of the histogram buckets for the number of queries per request
+METRICS_QUERY_BUCKETS = [1, 2, 5, 10, 20, 50, 100]
+
+# Alias of a read replica in settings.DATABASES (e.g. 'replica') which serves
+# the kiosk's lists of recent transactions and the admin's transaction lists;
+# None sends all queries to the primary
+REPLICA_DATABASE = None
+# Time in seconds a browser reads only from the primary after sending a
+# change (e.g. a purchase) so it sees the change
+REPLICA_PIN_S = 10
+# The replica isn't used while it lags behind the primary more than this many
+# seconds
+REPLICA_MAX_LAG_S = 5
+# Interval in seconds in which each process measures the replica's lag
+REPLICA_LAG_CHECK_S = 1
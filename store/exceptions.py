@@ -49,6 +49,11 @@ class ProductIdentifierNotExists(ClientMessageException):
         super().__init__('Kein Produkt unter der Identifikationsnummer registriert!')
 
 
+class TooManyProducts(ClientMessageException):
+    def __init__(self):
+        super().__init__('Zu viele Produkte auf einmal!')
+
+
 class SenderEqualsReceiverError(ClientMessageException):
     def __init__(self):
         super().__init__('Absender darf nicht auch der Adressat sein!')
@@ -0,0 +1,104 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# Export of transactions (e.g. for the accounting) as CSV or NDJSON. The rows
+# are streamed from a server-side cursor so the memory usage doesn't depend
+# on the number of exported rows.
+
+import csv
+import json
+from typing import Iterable, Iterator, List, Tuple
+
+from django.db.models import QuerySet
+
+import store.config as config
+import store.models as models
+
+
+# Exported columns per model as (column name, field); the names of related
+# users and products are joined in the query
+COLUMNS = {
+    models.Purchase: [
+        ('id', 'id'),
+        ('time_stamp', 'time_stamp'),
+        ('user', 'user__auth__username'),
+        ('product', 'product__name'),
+        ('price', 'price'),
+        ('annulled', 'annulled'),
+    ],
+    models.Charge: [
+        ('id', 'id'),
+        ('time_stamp', 'time_stamp'),
+        ('user', 'user__auth__username'),
+        ('amount', 'amount'),
+        ('admin', 'admin__auth__username'),
+        ('comment', 'comment'),
+        ('annulled', 'annulled'),
+    ],
+    models.Transfer: [
+        ('id', 'id'),
+        ('time_stamp', 'time_stamp'),
+        ('sender', 'sender__auth__username'),
+        ('receiver', 'receiver__auth__username'),
+        ('amount', 'amount'),
+        ('admin', 'admin__auth__username'),
+        ('comment', 'comment'),
+        ('annulled', 'annulled'),
+    ],
+}
+# Archived transactions are exported like the live ones
+COLUMNS[models.ArchivedPurchase] = COLUMNS[models.Purchase]
+COLUMNS[models.ArchivedCharge] = COLUMNS[models.Charge]
+COLUMNS[models.ArchivedTransfer] = COLUMNS[models.Transfer]
+
+
+def rows(queryset: QuerySet) -> Tuple[List[str], Iterator[tuple]]:
+    """
+    Return the column names and an iterator over the rows of the queryset
+    (one of the models in COLUMNS), oldest first.
+    """
+
+    columns = COLUMNS[queryset.model]
+    values = queryset \
+            .order_by('time_stamp', 'id') \
+            .values_list(*[x[1] for x in columns]) \
+            .iterator(chunk_size=config.EXPORT_CHUNK_SIZE)
+    return [x[0] for x in columns], values
+
+
+class Echo:
+    """
+    File-like object which returns the written value, used to let
+    csv.writer() generate single lines.
+    """
+
+    def write(self, value):
+        return value
+
+
+def csv_lines(queryset: QuerySet) -> Iterable[str]:
+    """
+    Return the queryset as CSV, line by line.
+    """
+
+    columns, values = rows(queryset)
+    writer = csv.writer(Echo())
+    yield writer.writerow(columns)
+    for row in values:
+        yield writer.writerow(row)
+
+
+def ndjson_lines(queryset: QuerySet) -> Iterable[str]:
+    """
+    Return the queryset as newline delimited JSON, one object per line.
+    """
+
+    columns, values = rows(queryset)
+    for row in values:
+        yield json.dumps(dict(zip(columns, row)), default=str) + '\n'
+
+
+# Format -> (generator, content type)
+FORMATS = {
+    'csv': (csv_lines, 'text/csv'),
+    'ndjson': (ndjson_lines, 'application/x-ndjson'),
+}
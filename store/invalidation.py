@@ -0,0 +1,199 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# Invalidation of the in-process caches (see store/cache.py) in all other
+# processes, possibly on other hosts. Each change is published with NOTIFY
+# once its transaction commits; every process listens in a background thread
+# and drops the affected cache entries. Each publication also increments a
+# sequence. The thread polls it while listening is not possible (e.g. the
+# connection dropped) and drops all caches when it changed.
+
+import logging
+import os
+import select
+import threading
+import uuid
+from typing import Callable, Dict, Optional
+
+from django.db import DatabaseError, connection, transaction
+
+import store.config as config
+import store.metrics as metrics
+
+
+CHANNEL = 'kaffeekasse_cache'
+# Created by the post_migrate handler in store/apps.py
+SEQUENCE = 'kaffeekasse_cache_version'
+
+logger = logging.getLogger(__name__)
+
+# Cache name -> function which drops the entry with the given key (None:
+# all entries)
+_handlers: Dict[str, Callable[[Optional[int]], None]] = {}
+
+_lock = threading.Lock()
+# Identifies the publications of this process, its caches are already
+# invalidated by the signal handlers
+_origin = uuid.uuid4().hex
+# Process which started the listener thread and the thread
+_listener_pid: Optional[int] = None
+_listener: Optional[threading.Thread] = None
+# Set while the listener thread receives notifications (not only polls)
+_listening = threading.Event()
+# Asks the listener thread to exit, see stop()
+_stop = threading.Event()
+
+
+def _reset() -> None:
+    global _lock, _origin, _listener_pid, _listener, _listening, _stop
+    # Another thread might have held the lock while forking
+    _lock = threading.Lock()
+    _origin = uuid.uuid4().hex
+    _listener_pid = None
+    _listener = None
+    _listening = threading.Event()
+    _stop = threading.Event()
+
+os.register_at_fork(after_in_child=_reset)
+
+
+def register(name: str, handler: Callable[[Optional[int]], None]) -> None:
+    """
+    Register the function which invalidates the cache name.
+    """
+
+    _handlers[name] = handler
+
+
+def publish(name: str, key: Optional[int] = None) -> None:
+    """
+    Invalidate the cache name (only the entry key if given) in all other
+    processes once the current transaction commits.
+    """
+
+    transaction.on_commit(lambda: _notify(name, key))
+
+
+def _notify(name: str, key: Optional[int]) -> None:
+    try:
+        with connection.cursor() as cursor:
+            # The payload is "origin version name [key]"
+            cursor.execute('''
+                SELECT pg_notify(%s, concat_ws(' ', %s, nextval(%s), %s, %s))
+                ''', [CHANNEL, _origin, SEQUENCE, name, key])
+    except DatabaseError as e:
+        # The transaction is already committed, don't fail the request
+        logger.error('publishing invalidation of %s failed: %s', name, e)
+
+
+def start() -> None:
+    """
+    Start the listener thread of this process unless it's running.
+    """
+
+    global _listener_pid, _listener
+
+    if _listener_pid == os.getpid():
+        return
+    with _lock:
+        if _listener_pid == os.getpid():
+            return
+        _listener_pid = os.getpid()
+        _stop.clear()
+        _listener = threading.Thread(target=_listen, name='cache-invalidation',
+                                     daemon=True)
+        _listener.start()
+
+
+def stop() -> None:
+    """
+    Stop the listener thread and close its connection (e.g. before the test
+    database is dropped). The next cache access starts it again.
+    """
+
+    global _listener_pid, _listener
+
+    with _lock:
+        if _listener is None:
+            return
+        _stop.set()
+        # Exits within CACHE_POLL_INTERVAL_S
+        _listener.join()
+        _listener_pid = None
+        _listener = None
+
+
+def _invalidate_all() -> None:
+    for handler in _handlers.values():
+        handler(None)
+
+
+def _handle(payload: str) -> int:
+    """
+    Invalidate the cache entry of the notification. Return its version.
+    """
+
+    origin, version, name, *key = payload.split(' ')
+    if origin != _origin and name in _handlers:
+        _handlers[name](int(key[0]) if key else None)
+        metrics.inc('cache_invalidations', cache=name)
+    return int(version)
+
+
+def _poll(version: Optional[int]) -> int:
+    """
+    Drop all caches if any invalidation was published since version. Return
+    the current version.
+    """
+
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT last_value FROM {}'.format(SEQUENCE))
+        current = cursor.fetchone()[0]
+    if current != version:
+        _invalidate_all()
+    return current
+
+
+def _listen() -> None:
+    # Latest version whose invalidation is applied; None drops everything
+    # cached before listening
+    version = None
+    while not _stop.is_set():
+        try:
+            version = _poll(version)
+            with connection.cursor() as cursor:
+                cursor.execute('LISTEN {}'.format(CHANNEL))
+            # Catch the invalidations published before LISTEN
+            version = _poll(version)
+            if not _listening.is_set():
+                logger.info('listening for cache invalidations')
+                _listening.set()
+
+            conn = connection.connection
+            while not _stop.is_set():
+                if not select.select([conn], [], [], config.CACHE_POLL_INTERVAL_S)[0]:
+                    # Notice dropped connections and missed notifications
+                    version = _poll(version)
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    version = max(version, _handle(conn.notifies.pop(0).payload))
+
+        except Exception as e:
+            if _listening.is_set():
+                logger.warning('listening for cache invalidations failed, '
+                               'polling: %s', e)
+                _listening.clear()
+            metrics.inc('cache_listener_failures')
+            # Reconnect on the next attempt
+            try:
+                connection.close()
+            except Exception:
+                pass
+            # Polling is the first thing of the next attempt
+            _stop.wait(config.CACHE_POLL_INTERVAL_S)
+
+    _listening.clear()
+    connection.close()
+
+
+metrics.gauge('cache_listening', lambda: 1 if _listening.is_set() else 0)
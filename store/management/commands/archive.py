@@ -0,0 +1,118 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+from datetime import datetime, time, timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Min
+from django.utils import timezone
+
+import store.config as config
+import store.models as models
+
+
+TABLES = {
+    'purchase': models.Purchase._meta.db_table,
+    'purchasecount': models.PurchaseCount._meta.db_table,
+    'charge': models.Charge._meta.db_table,
+    'transfer': models.Transfer._meta.db_table,
+    'archived_purchase': models.ArchivedPurchase._meta.db_table,
+    'archived_charge': models.ArchivedCharge._meta.db_table,
+    'archived_transfer': models.ArchivedTransfer._meta.db_table,
+    'checkpoint': models.BalanceCheckpoint._meta.db_table,
+}
+
+
+class Command(BaseCommand):
+    help = 'Move old purchases, charges and transfers to the archive tables. ' \
+           'Their sum per user is kept as balance checkpoint.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=config.ARCHIVE_AFTER_D,
+                            help='archive transactions older than this many '
+                                 'days (default: %(default)s)')
+
+    def horizon(self, days):
+        """
+        Return the time before which transactions are archived.
+        """
+
+        horizon = timezone.now() - timedelta(days=days)
+        # Never archive transactions which weren't billed yet
+        last_mail = models.UserData.objects.aggregate(x=Min('last_mail'))['x']
+        if last_mail is not None:
+            horizon = min(horizon, last_mail)
+        # Nor transactions which can still be annulled
+        annullable = max(config.T_ANNULLABLE_PURCHASE_M,
+                         config.T_ANNULLABLE_CHARGE_M,
+                         config.T_ANNULLABLE_TRANSFERS_M)
+        horizon = min(horizon, timezone.now() - timedelta(minutes=annullable))
+
+        # Start of a (local) day so the purchase counts of older days can be
+        # dropped as well
+        day = timezone.localdate(horizon)
+        return timezone.make_aware(datetime.combine(day, time()))
+
+    def execute_sql(self, sql, params):
+        with connection.cursor() as cursor:
+            cursor.execute(sql.format(**TABLES), params)
+            return cursor.rowcount
+
+    def handle(self, *args, **options):
+        horizon = self.horizon(options['days'])
+        params = {
+            'horizon': horizon,
+            'day': timezone.localdate(horizon),
+        }
+
+        with transaction.atomic():
+            # Add the archived transactions to each user's checkpoint
+            users = self.execute_sql('''
+                INSERT INTO {checkpoint} AS c (user_id, time_stamp, amount)
+                SELECT user_id, %(horizon)s, sum(amount) FROM (
+                    SELECT user_id, amount FROM {charge}
+                    WHERE time_stamp < %(horizon)s AND NOT annulled
+                    UNION ALL
+                    SELECT user_id, -price FROM {purchase}
+                    WHERE time_stamp < %(horizon)s AND NOT annulled
+                    UNION ALL
+                    SELECT receiver_id, amount FROM {transfer}
+                    WHERE time_stamp < %(horizon)s AND NOT annulled
+                          AND receiver_id IS NOT NULL
+                    UNION ALL
+                    SELECT sender_id, -amount FROM {transfer}
+                    WHERE time_stamp < %(horizon)s AND NOT annulled
+                          AND sender_id IS NOT NULL
+                ) AS x
+                GROUP BY user_id
+                ON CONFLICT (user_id) DO UPDATE
+                SET amount = c.amount + EXCLUDED.amount,
+                    time_stamp = EXCLUDED.time_stamp
+                ''', params)
+
+            purchases = self.execute_sql('''
+                WITH x AS (DELETE FROM {purchase} WHERE time_stamp < %(horizon)s
+                           RETURNING id, user_id, product_id, time_stamp, price, annulled)
+                INSERT INTO {archived_purchase} (id, user_id, product_id, time_stamp, price, annulled)
+                SELECT * FROM x
+                ''', params)
+            charges = self.execute_sql('''
+                WITH x AS (DELETE FROM {charge} WHERE time_stamp < %(horizon)s
+                           RETURNING id, user_id, time_stamp, amount, annulled, admin_id, comment)
+                INSERT INTO {archived_charge} (id, user_id, time_stamp, amount, annulled, admin_id, comment)
+                SELECT * FROM x
+                ''', params)
+            transfers = self.execute_sql('''
+                WITH x AS (DELETE FROM {transfer} WHERE time_stamp < %(horizon)s
+                           RETURNING id, sender_id, receiver_id, time_stamp, amount, annulled, admin_id, comment)
+                INSERT INTO {archived_transfer} (id, sender_id, receiver_id, time_stamp, amount, annulled, admin_id, comment)
+                SELECT * FROM x
+                ''', params)
+
+            # Only used for the last days
+            self.execute_sql('DELETE FROM {purchasecount} WHERE day < %(day)s', params)
+
+        self.stdout.write('Archived {} purchases, {} charges and {} transfers '
+                          'before {} ({} checkpoints updated)'.format(
+                              purchases, charges, transfers,
+                              timezone.localtime(horizon), users))
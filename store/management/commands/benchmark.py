@@ -0,0 +1,169 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import contextlib
+import json
+import math
+import random
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import timezone
+
+import store.models as models
+
+
+def percentile(values, p):
+    """
+    Return the p-th percentile (nearest-rank method) of the sorted values.
+    """
+
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+class Command(BaseCommand):
+    help = 'Measure throughput, latency and queries per request of the kiosk ' \
+           'pages. Run it against a seeded database (see the "seed" ' \
+           'command), it performs purchases.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200,
+                            help='number of requests per scenario')
+        parser.add_argument('--seed', type=int, default=0,
+                            help='seed for the random number generator')
+        parser.add_argument('--output',
+                            help='file for the JSON results (default: '
+                                 'benchmark-<time>.json)')
+
+    def scenarios(self):
+        """
+        Return the scenarios as list of (name, login required, request
+        function). Each function gets a random user and returns the
+        response.
+        """
+
+        products = list(models.ProductIdentifier.objects
+                .filter(ident_type=models.ProductIdentifier.BARCODE)
+                .values_list('ident', flat=True))
+
+        def index(client, user):
+            return client.get('/')
+
+        def login(client, user):
+            return client.post('/login', {
+                'ident': user['ident'],
+                'ident_type': models.UserIdentifier.RFID,
+            })
+
+        def buy_get(client, user):
+            return client.get('/buy')
+
+        def catalog(client, user):
+            return client.get('/catalog.json')
+
+        def buy_post(client, user):
+            return client.post('/buy', {
+                'ident': random.choice(products),
+                'ident_type': models.ProductIdentifier.BARCODE,
+            })
+
+        def transfer_get(client, user):
+            return client.get('/transfer')
+
+        def charge_get(client, user):
+            return client.get('/charge')
+
+        return [
+            ('index', False, index),
+            ('login', False, login),
+            ('buy GET', True, buy_get),
+            ('catalog GET', True, catalog),
+            ('buy POST', True, buy_post),
+            ('transfer GET', True, transfer_get),
+            ('charge GET', True, charge_get),
+        ]
+
+    def run(self, login, func, users, count):
+        client = Client()
+        latencies = []
+        queries = 0
+        errors = 0
+
+        # Warm up caches, connections, etc.
+        user = random.choice(users)
+        if login:
+            client.force_login(user['auth'])
+        func(client, user)
+
+        for _ in range(count):
+            user = random.choice(users)
+            if login:
+                client.force_login(user['auth'])
+            # Also the reads sent to the replica (if configured)
+            with contextlib.ExitStack() as stack:
+                captured = [stack.enter_context(CaptureQueriesContext(x))
+                            for x in connections.all()]
+                start = time.perf_counter()
+                response = func(client, user)
+                latencies.append(time.perf_counter() - start)
+            queries += sum(len(x) for x in captured)
+            if response.status_code >= 400:
+                errors += 1
+
+        total = sum(latencies)
+        latencies.sort()
+        return {
+            'requests': count,
+            'errors': errors,
+            'throughput': count / total,
+            'p50_ms': percentile(latencies, 50) * 1000,
+            'p95_ms': percentile(latencies, 95) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000,
+            'queries': queries / count,
+        }
+
+    def handle(self, *args, **options):
+        random.seed(options['seed'])
+
+        users = [{'auth': x.user.auth, 'ident': x.ident} for x in
+                 models.UserIdentifier.objects
+                    .filter(ident_type=models.UserIdentifier.RFID)
+                    .select_related('user__auth')]
+        if not users:
+            raise CommandError('no users with RFID identifiers, seed the database first')
+
+        results = {}
+        # The test client uses "testserver" as host name
+        with override_settings(ALLOWED_HOSTS=settings.ALLOWED_HOSTS + ['testserver']):
+            for name, login, func in self.scenarios():
+                results[name] = self.run(login, func, users, options['requests'])
+                x = results[name]
+                self.stdout.write('{:14} {:8.1f} req/s  p50 {:7.1f} ms  '
+                                  'p95 {:7.1f} ms  p99 {:7.1f} ms  '
+                                  '{:5.1f} queries  {} errors'.format(
+                                      name, x['throughput'], x['p50_ms'],
+                                      x['p95_ms'], x['p99_ms'], x['queries'],
+                                      x['errors']))
+
+        now = timezone.now()
+        output = options['output']
+        if output is None:
+            output = 'benchmark-{}.json'.format(now.strftime('%Y%m%d-%H%M%S'))
+        with open(output, 'w') as f:
+            json.dump({
+                'time': now.isoformat(),
+                'options': {
+                    'requests': options['requests'],
+                    'seed': options['seed'],
+                },
+                'database': {
+                    'users': models.UserData.objects.count(),
+                    'products': models.Product.objects.count(),
+                    'purchases': models.Purchase.objects.count(),
+                },
+                'results': results,
+            }, f, indent=4)
+        self.stdout.write('results written to {}'.format(output))
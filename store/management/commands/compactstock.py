@@ -0,0 +1,45 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+import store.config as config
+import store.models as models
+
+
+class Command(BaseCommand):
+    help = "Add the pending stock changes of the purchases to the products' " \
+           'stock. Run it periodically (e.g. from cron) or with --loop.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true',
+                            help='keep running, compact every '
+                                 'STOCK_COMPACT_INTERVAL_S seconds')
+
+    def compact(self):
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                # Only the deleted changes are added, concurrently inserted
+                # ones are left for the next run. READ COMMITTED prevents
+                # serialization failures of the purchases which read the
+                # products.
+                cursor.execute('SET TRANSACTION ISOLATION LEVEL READ COMMITTED')
+                cursor.execute('''
+                    WITH d AS (DELETE FROM {change} RETURNING product_id, amount),
+                         s AS (SELECT product_id, sum(amount) AS amount FROM d
+                               GROUP BY product_id)
+                    UPDATE {product} AS p SET stock = p.stock + s.amount
+                    FROM s WHERE p.id = s.product_id
+                    '''.format(change=models.StockChange._meta.db_table,
+                               product=models.Product._meta.db_table))
+                return cursor.rowcount
+
+    def handle(self, *args, **options):
+        while True:
+            count = self.compact()
+            if not options['loop']:
+                self.stdout.write('stock of {} products updated'.format(count))
+                break
+            time.sleep(config.STOCK_COMPACT_INTERVAL_S)
@@ -0,0 +1,76 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+import store.export as export
+import store.models as models
+
+
+MODELS = {
+    'purchases': models.Purchase,
+    'charges': models.Charge,
+    'transfers': models.Transfer,
+}
+ARCHIVED_MODELS = {
+    'purchases': models.ArchivedPurchase,
+    'charges': models.ArchivedCharge,
+    'transfers': models.ArchivedTransfer,
+}
+
+
+def local_date(value):
+    return timezone.make_aware(datetime.strptime(value, '%Y-%m-%d'))
+
+
+class Command(BaseCommand):
+    help = 'Export transactions as CSV or NDJSON (newline delimited JSON).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=sorted(MODELS))
+        parser.add_argument('--format', choices=sorted(export.FORMATS),
+                            default='csv')
+        parser.add_argument('--since', type=local_date,
+                            help='first day (YYYY-MM-DD) to export')
+        parser.add_argument('--until', type=local_date,
+                            help='day (YYYY-MM-DD) after the last exported day')
+        parser.add_argument('--user',
+                            help='only export transactions of this user '
+                                 '(username)')
+        parser.add_argument('--archived', action='store_true',
+                            help='export the archived transactions (see the '
+                                 '"archive" command)')
+        parser.add_argument('--output',
+                            help='file to write to (default: stdout)')
+
+    def handle(self, *args, **options):
+        if options['archived']:
+            model = ARCHIVED_MODELS[options['kind']]
+        else:
+            model = MODELS[options['kind']]
+
+        queryset = model.objects.all()
+        if options['since'] is not None:
+            queryset = queryset.filter(time_stamp__gte=options['since'])
+        if options['until'] is not None:
+            queryset = queryset.filter(time_stamp__lt=options['until'])
+        if options['user'] is not None:
+            user = models.UserData.objects \
+                    .filter(auth__username=options['user']).first()
+            if user is None:
+                raise CommandError('unknown user {}'.format(options['user']))
+            if model in (models.Transfer, models.ArchivedTransfer):
+                queryset = queryset.filter(sender=user) | queryset.filter(receiver=user)
+            else:
+                queryset = queryset.filter(user=user)
+
+        lines, _ = export.FORMATS[options['format']]
+        if options['output'] is None:
+            for line in lines(queryset):
+                self.stdout.write(line, ending='')
+            return
+        with open(options['output'], 'w', newline='') as f:
+            for line in lines(queryset):
+                f.write(line)
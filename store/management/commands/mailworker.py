@@ -0,0 +1,31 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import time
+
+from django.core.management.base import BaseCommand
+
+import store.config as config
+import store.notify as notify
+
+
+class Command(BaseCommand):
+    help = 'Send the notification mails queued in the outbox.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help='exit once the outbox is empty')
+        parser.add_argument('--batch-size', type=int,
+                            default=config.MAIL_BATCH_SIZE,
+                            help='number of mails sent per transaction')
+
+    def handle(self, *args, **options):
+        with notify.Mailer() as mailer:
+            while True:
+                count = notify.send_queued_mails(mailer, options['batch_size'])
+                if count > 0:
+                    continue
+                if options['once']:
+                    break
+                # Don't keep the idle connection open
+                mailer.close()
+                time.sleep(config.MAIL_POLL_INTERVAL_S)
@@ -0,0 +1,27 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+import store.config as config
+import store.models as models
+
+
+class Command(BaseCommand):
+    help = 'Delete unknown identifiers of failed logins which were not ' \
+           'scanned again recently. Run it periodically (e.g. from cron).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int,
+                            default=config.T_UNKNOWN_IDENTIFIERS_D,
+                            help='keep identifiers scanned within this many '
+                                 'days (default: %(default)s)')
+
+    def handle(self, *args, **options):
+        time_stamp = timezone.now() - timedelta(days=options['days'])
+        count, _ = models.UnknownUserIdentifier.objects \
+                .filter(last_seen__lt=time_stamp) \
+                .delete()
+        self.stdout.write('{} unknown identifiers deleted'.format(count))
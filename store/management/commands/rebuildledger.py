@@ -0,0 +1,100 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+import store.models as models
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the ledger from all purchases, charges and transfers ' \
+           '(e.g. for data from before the ledger existed). Annulled ' \
+           'transactions only store the time of their annulment, their ' \
+           'original booking is placed at the same time.'
+
+    def handle(self, *args, **options):
+        LedgerEntry = models.LedgerEntry
+        tables = {
+            'ledger': LedgerEntry._meta.db_table,
+            'purchase': models.Purchase._meta.db_table,
+            'charge': models.Charge._meta.db_table,
+            'transfer': models.Transfer._meta.db_table,
+            'archived_purchase': models.ArchivedPurchase._meta.db_table,
+            'archived_charge': models.ArchivedCharge._meta.db_table,
+            'archived_transfer': models.ArchivedTransfer._meta.db_table,
+        }
+        # Include the archived transactions
+        union = '(SELECT {0} FROM {1} UNION ALL SELECT {0} FROM {2})'
+        tables.update({
+            'purchases': union.format('id, user_id, time_stamp, price, annulled',
+                                      tables['purchase'], tables['archived_purchase']),
+            'charges': union.format('id, user_id, time_stamp, amount, annulled',
+                                    tables['charge'], tables['archived_charge']),
+            'transfers': union.format('id, sender_id, receiver_id, time_stamp, amount, annulled',
+                                      tables['transfer'], tables['archived_transfer']),
+        })
+        params = {
+            'purchase': LedgerEntry.PURCHASE,
+            'purchase_annulment': LedgerEntry.PURCHASE_ANNULMENT,
+            'charge': LedgerEntry.CHARGE,
+            'charge_annulment': LedgerEntry.CHARGE_ANNULMENT,
+            'transfer': LedgerEntry.TRANSFER,
+            'transfer_annulment': LedgerEntry.TRANSFER_ANNULMENT,
+        }
+
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                # Lock the transactions so nothing is missed or booked twice
+                cursor.execute('LOCK TABLE {purchase}, {charge}, {transfer}, '
+                               '{archived_purchase}, {archived_charge}, '
+                               '{archived_transfer} IN SHARE MODE'.format(**tables))
+                cursor.execute('DELETE FROM {ledger}'.format(**tables))
+                # Each annulment is booked after the annulled transaction
+                cursor.execute('''
+                    INSERT INTO {ledger} (user_id, time_stamp, kind, amount, balance,
+                                          purchase_id, charge_id, transfer_id)
+                    SELECT user_id, time_stamp, kind, amount,
+                           sum(amount) OVER (PARTITION BY user_id
+                                             ORDER BY time_stamp, annulment, id
+                                             ROWS UNBOUNDED PRECEDING),
+                           purchase_id, charge_id, transfer_id
+                    FROM (
+                        SELECT user_id, time_stamp, %(purchase)s AS kind,
+                               -price AS amount, false AS annulment, id,
+                               id AS purchase_id, NULL::int AS charge_id,
+                               NULL::int AS transfer_id
+                        FROM {purchases} AS p
+                        UNION ALL
+                        SELECT user_id, time_stamp, %(purchase_annulment)s,
+                               price, true, id, id, NULL, NULL
+                        FROM {purchases} AS p WHERE annulled
+                        UNION ALL
+                        SELECT user_id, time_stamp, %(charge)s,
+                               amount, false, id, NULL, id, NULL
+                        FROM {charges} AS c
+                        UNION ALL
+                        SELECT user_id, time_stamp, %(charge_annulment)s,
+                               -amount, true, id, NULL, id, NULL
+                        FROM {charges} AS c WHERE annulled
+                        UNION ALL
+                        SELECT sender_id, time_stamp, %(transfer)s,
+                               -amount, false, id, NULL, NULL, id
+                        FROM {transfers} AS t WHERE sender_id IS NOT NULL
+                        UNION ALL
+                        SELECT receiver_id, time_stamp, %(transfer)s,
+                               amount, false, id, NULL, NULL, id
+                        FROM {transfers} AS t WHERE receiver_id IS NOT NULL
+                        UNION ALL
+                        SELECT sender_id, time_stamp, %(transfer_annulment)s,
+                               amount, true, id, NULL, NULL, id
+                        FROM {transfers} AS t WHERE annulled AND sender_id IS NOT NULL
+                        UNION ALL
+                        SELECT receiver_id, time_stamp, %(transfer_annulment)s,
+                               -amount, true, id, NULL, NULL, id
+                        FROM {transfers} AS t WHERE annulled AND receiver_id IS NOT NULL
+                    ) AS x
+                    ORDER BY user_id, time_stamp, annulment, id
+                    '''.format(**tables), params)
+                count = cursor.rowcount
+
+        self.stdout.write('{} ledger entries rebuilt'.format(count))
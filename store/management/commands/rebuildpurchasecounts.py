@@ -0,0 +1,33 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+
+import store.models as models
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the per user and day purchase counts from all purchases.'
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                # Lock the purchases so no purchase is missed or counted twice
+                cursor.execute('LOCK TABLE {} IN SHARE MODE'
+                               .format(models.Purchase._meta.db_table))
+                cursor.execute('DELETE FROM {}'
+                               .format(models.PurchaseCount._meta.db_table))
+                cursor.execute('INSERT INTO {} (user_id, product_id, day, count) '
+                               'SELECT user_id, product_id, '
+                               '       (time_stamp AT TIME ZONE %s)::date, '
+                               '       count(*) '
+                               'FROM {} '
+                               'WHERE NOT annulled AND product_id IS NOT NULL '
+                               'GROUP BY 1, 2, 3'
+                               .format(models.PurchaseCount._meta.db_table,
+                                       models.Purchase._meta.db_table),
+                               [timezone.get_current_timezone_name()])
+                count = cursor.rowcount
+
+        self.stdout.write('{} purchase counts rebuilt'.format(count))
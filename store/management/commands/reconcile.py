@@ -0,0 +1,199 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import django.contrib.auth.models
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+
+import store.config as config
+import store.models as models
+
+
+TABLES = {
+    'user': django.contrib.auth.models.User._meta.db_table,
+    'userdata': models.UserData._meta.db_table,
+    'purchase': models.Purchase._meta.db_table,
+    'purchasecount': models.PurchaseCount._meta.db_table,
+    'charge': models.Charge._meta.db_table,
+    'transfer': models.Transfer._meta.db_table,
+    'ledger': models.LedgerEntry._meta.db_table,
+    'checkpoint': models.BalanceCheckpoint._meta.db_table,
+}
+
+# Money of each user according to the non-annulled transactions (and the
+# checkpoint of the archived ones); one grouped aggregation per table instead
+# of one query per user
+EXPECTED_MONEY = '''
+    SELECT u.id, a.username, u.money,
+           coalesce(cp.amount, 0)
+           + coalesce(c.sum, 0) - coalesce(p.sum, 0)
+           + coalesce(i.sum, 0) - coalesce(o.sum, 0) AS expected
+    FROM {userdata} AS u
+    JOIN {user} AS a ON a.id = u.auth_id
+    LEFT JOIN {checkpoint} AS cp ON cp.user_id = u.id
+    LEFT JOIN (SELECT user_id, sum(amount) AS sum FROM {charge}
+               WHERE NOT annulled GROUP BY user_id) AS c ON c.user_id = u.id
+    LEFT JOIN (SELECT user_id, sum(price) AS sum FROM {purchase}
+               WHERE NOT annulled GROUP BY user_id) AS p ON p.user_id = u.id
+    LEFT JOIN (SELECT receiver_id, sum(amount) AS sum FROM {transfer}
+               WHERE NOT annulled GROUP BY receiver_id) AS i ON i.receiver_id = u.id
+    LEFT JOIN (SELECT sender_id, sum(amount) AS sum FROM {transfer}
+               WHERE NOT annulled GROUP BY sender_id) AS o ON o.sender_id = u.id
+'''
+
+# Differences between the money and the expected money
+MONEY = '''
+    SELECT id, username, money, expected FROM (''' + EXPECTED_MONEY + ''') AS x
+    WHERE money <> expected
+    ORDER BY username
+'''
+
+# Differences which can't be repaired because the expected money violates the
+# money_min_limit constraint
+UNREPAIRABLE_MONEY = '''
+    SELECT id, username, money, expected FROM (''' + EXPECTED_MONEY + ''') AS x
+    WHERE money <> expected AND expected < %(limit)s
+    ORDER BY username
+'''
+
+# Differences between the money and the balance of the user's last ledger
+# entry
+LEDGER = '''
+    SELECT u.id, a.username, u.money, l.balance
+    FROM {userdata} AS u
+    JOIN {user} AS a ON a.id = u.auth_id
+    LEFT JOIN (SELECT DISTINCT ON (user_id) user_id, balance FROM {ledger}
+               ORDER BY user_id, time_stamp DESC, id DESC) AS l ON l.user_id = u.id
+    WHERE u.money <> coalesce(l.balance, 0)
+    ORDER BY a.username
+'''
+
+# Differences between the purchase counts and the purchases
+PURCHASE_COUNTS = '''
+    SELECT coalesce(p.user_id, c.user_id), coalesce(p.product_id, c.product_id),
+           coalesce(p.day, c.day), coalesce(c.count, 0), coalesce(p.count, 0)
+    FROM (SELECT user_id, product_id, (time_stamp AT TIME ZONE %(tz)s)::date AS day,
+                 count(*) AS count
+          FROM {purchase}
+          WHERE NOT annulled AND product_id IS NOT NULL
+          GROUP BY 1, 2, 3) AS p
+    FULL JOIN {purchasecount} AS c
+        ON c.user_id = p.user_id AND c.product_id = p.product_id AND c.day = p.day
+    WHERE coalesce(c.count, 0) <> coalesce(p.count, 0)
+    ORDER BY 1, 2, 3
+'''
+
+
+class Command(BaseCommand):
+    help = "Check the users' money against their transactions and the " \
+           'ledger, and the purchase counts against the purchases. Fails ' \
+           'if there are differences unless they are repaired.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repair', action='store_true',
+                            help='set the money to the expected value (booked '
+                                 'as correction in the ledger) and rebuild '
+                                 'the purchase counts')
+
+    def differences(self, sql, params=None):
+        """
+        Return the rows of the query. The rows are streamed through a
+        server-side cursor, the differences might be huge (e.g. the ledger
+        of an old installation was never built).
+        """
+
+        with connection.chunked_cursor() as cursor:
+            cursor.execute(sql.format(**TABLES), params)
+            yield from cursor
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                # Prevent new transactions while checking and repairing so
+                # the results stay valid
+                cursor.execute('LOCK TABLE {purchase}, {charge}, {transfer} '
+                               'IN SHARE MODE'.format(**TABLES))
+
+            money = 0
+            for _, username, current, expected in self.differences(MONEY):
+                self.stdout.write('Money of {}: {} € instead of {} €'
+                                  .format(username, current, expected))
+                money += 1
+
+            ledger = 0
+            for _, username, current, balance in self.differences(LEDGER):
+                self.stdout.write('Ledger of {}: {} € instead of {} €'
+                                  .format(username, balance, current))
+                ledger += 1
+
+            counts = 0
+            for user_id, product_id, day, count, expected in self.differences(
+                    PURCHASE_COUNTS, {'tz': timezone.get_current_timezone_name()}):
+                self.stdout.write('Purchase count of user {} for product {} on {}: '
+                                  '{} instead of {}'
+                                  .format(user_id, product_id, day, count, expected))
+                counts += 1
+
+            self.stdout.write('{} money, {} ledger and {} purchase count '
+                              'differences'.format(money, ledger, counts))
+            if not money and not ledger and not counts:
+                return
+            if not options['repair']:
+                raise CommandError('differences found, use --repair to fix them')
+
+            unrepairable = 0
+            if money or ledger:
+                unrepairable = self.repair_money()
+            if counts:
+                call_command('rebuildpurchasecounts', stdout=self.stdout)
+
+        # After the commit to keep the other repairs
+        if unrepairable:
+            raise CommandError('{} users not repaired, their expected money '
+                               'is below the limit'.format(unrepairable))
+
+    def repair_money(self):
+        """
+        Repair the money and ledger of all users except those whose expected
+        money is below MONEY_MIN_LIMIT (the constraint would abort the
+        repair). Return the number of these users.
+        """
+
+        unrepairable = 0
+        for _, username, current, expected in self.differences(
+                UNREPAIRABLE_MONEY, {'limit': config.MONEY_MIN_LIMIT}):
+            self.stdout.write('Money of {} not repaired: expected {} € is below '
+                              'the limit of {} €'
+                              .format(username, expected, config.MONEY_MIN_LIMIT))
+            unrepairable += 1
+
+        with connection.cursor() as cursor:
+            # Book the difference to the ledger's balance (or the expected
+            # money) as correction so the last ledger entry matches again
+            cursor.execute(('''
+                WITH x AS (''' + EXPECTED_MONEY + '''),
+                     l AS (SELECT DISTINCT ON (user_id) user_id, balance FROM {ledger}
+                           ORDER BY user_id, time_stamp DESC, id DESC)
+                INSERT INTO {ledger} (user_id, time_stamp, kind, amount, balance)
+                SELECT x.id, %(now)s, %(kind)s,
+                       x.expected - coalesce(l.balance, 0), x.expected
+                FROM x LEFT JOIN l ON l.user_id = x.id
+                WHERE x.expected <> coalesce(l.balance, 0) AND x.expected >= %(limit)s
+                ''').format(**TABLES), {
+                    'now': timezone.now(),
+                    'kind': models.LedgerEntry.CORRECTION,
+                    'limit': config.MONEY_MIN_LIMIT,
+                })
+            ledger = cursor.rowcount
+
+            cursor.execute(('''
+                UPDATE {userdata} AS u SET money = x.expected
+                FROM (''' + EXPECTED_MONEY + ''') AS x
+                WHERE u.id = x.id AND u.money <> x.expected AND x.expected >= %s
+                ''').format(**TABLES), [config.MONEY_MIN_LIMIT])
+            money = cursor.rowcount
+
+        self.stdout.write('{} users repaired, {} ledger corrections booked'
+                          .format(money, ledger))
+        return unrepairable
@@ -0,0 +1,188 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import random
+import time
+from decimal import Decimal
+
+import django.contrib.auth.models
+from django.contrib.auth.hashers import make_password
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+
+import store.models as models
+
+
+class Command(BaseCommand):
+    help = 'Fill the database with synthetic users, products and ' \
+           'transactions (e.g. for benchmarks). All users have the password ' \
+           '"seed".'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--categories', type=int, default=10)
+        parser.add_argument('--products', type=int, default=100)
+        parser.add_argument('--years', type=float, default=2,
+                            help='time span of the generated transactions')
+        parser.add_argument('--purchases', type=float, default=2,
+                            help='average purchases per user and day')
+        parser.add_argument('--charges', type=float, default=2,
+                            help='average charges per user and month')
+        parser.add_argument('--transfers', type=float, default=1,
+                            help='average transfers per user and month')
+        parser.add_argument('--seed', type=int, default=0,
+                            help='seed for the random number generators')
+
+    def execute_sql(self, sql, params):
+        tables = {
+            'userdata': models.UserData._meta.db_table,
+            'product': models.Product._meta.db_table,
+            'purchase': models.Purchase._meta.db_table,
+            'charge': models.Charge._meta.db_table,
+            'transfer': models.Transfer._meta.db_table,
+        }
+        with connection.cursor() as cursor:
+            cursor.execute(sql.format(**tables), params)
+            return cursor.rowcount
+
+    def handle(self, *args, **options):
+        User = django.contrib.auth.models.User
+
+        if User.objects.filter(username__startswith='seed').exists():
+            raise CommandError('database was already seeded')
+
+        random.seed(options['seed'])
+        days = int(options['years'] * 365)
+        now = timezone.now()
+
+        start = time.monotonic()
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT setseed(%s)', [options['seed'] / 2**31])
+
+            # Hash the password only once, it's slow on purpose
+            password = make_password('seed')
+            users = User.objects.bulk_create([
+                User(username='seed{}'.format(i), password=password,
+                     first_name='Vorname{}'.format(i),
+                     last_name='Nachname{}'.format(i),
+                     email='seed{}@example.org'.format(i))
+                for i in range(options['users'])])
+            # bulk_create() doesn't trigger post_create_user_profile()
+            users = models.UserData.objects.bulk_create([
+                models.UserData(auth=x, idm='sd{}'.format(i))
+                for i, x in enumerate(users)])
+            models.UserIdentifier.objects.bulk_create(
+                [models.UserIdentifier(user=x, ident_type=models.UserIdentifier.RFID,
+                                       ident='seed-rfid-{}'.format(x.id))
+                 for x in users] +
+                [models.UserIdentifier(user=x, ident_type=models.UserIdentifier.ID,
+                                       ident=str(100000 + x.id))
+                 for x in users])
+
+            categories = models.ProductCategory.objects.bulk_create([
+                models.ProductCategory(
+                    toplevel=random.choice(models.ProductCategory.choices)[0],
+                    sublevel='Seed-Kategorie {}'.format(i))
+                for i in range(options['categories'])])
+            products = models.Product.objects.bulk_create([
+                models.Product(name='Seed-Produkt {}'.format(i),
+                               category=random.choice(categories),
+                               stock=random.randrange(100),
+                               price=Decimal(random.randrange(10, 300)) / 100)
+                for i in range(options['products'])])
+            models.ProductIdentifier.objects.bulk_create([
+                models.ProductIdentifier(product=x,
+                                         ident_type=models.ProductIdentifier.BARCODE,
+                                         ident='seed-barcode-{}'.format(x.id))
+                for x in products])
+            self.stdout.write('{} users, {} products ({:.1f} s)'.format(
+                len(users), len(products), time.monotonic() - start))
+
+            # Transactions are generated in the database, it's much faster than
+            # creating millions of model instances (and auto_now would
+            # overwrite their time stamps)
+            user_ids = [x.id for x in users]
+            product_ids = [x.id for x in products]
+            params = {
+                'users': user_ids,
+                'products': product_ids,
+                'now': now,
+                'days': days,
+            }
+
+            count = self.execute_sql('''
+                INSERT INTO {purchase} (user_id, product_id, time_stamp, price, annulled)
+                SELECT u, pr.id, t, pr.price, random() < 0.01
+                FROM (SELECT (%(users)s::int[])[1 + floor(random() * cardinality(%(users)s::int[]))] AS u,
+                             (%(products)s::int[])[1 + floor(random() * cardinality(%(products)s::int[]))] AS p,
+                             %(now)s - random() * %(days)s * interval '1 day' AS t
+                      FROM generate_series(1, %(count)s)) AS x
+                JOIN {product} AS pr ON pr.id = x.p
+                ''', dict(params, count=int(len(users) * days * options['purchases'])))
+            self.stdout.write('{} purchases ({:.1f} s)'.format(
+                count, time.monotonic() - start))
+
+            count = self.execute_sql('''
+                INSERT INTO {charge} (user_id, time_stamp, amount, annulled, comment)
+                SELECT (%(users)s::int[])[1 + floor(random() * cardinality(%(users)s::int[]))],
+                       %(now)s - random() * %(days)s * interval '1 day',
+                       (1 + floor(random() * 5)) * 10,
+                       random() < 0.01,
+                       ''
+                FROM generate_series(1, %(count)s)
+                ''', dict(params, count=int(len(users) * days / 30 * options['charges'])))
+            self.stdout.write('{} charges ({:.1f} s)'.format(
+                count, time.monotonic() - start))
+
+            count = 0
+            if len(users) > 1:
+                count = self.execute_sql('''
+                    INSERT INTO {transfer} (sender_id, receiver_id, time_stamp, amount, annulled, comment)
+                    SELECT u[1 + s], u[1 + (s + 1 + floor(random() * (cardinality(u) - 1))::int) %% cardinality(u)],
+                           t, a, annulled, ''
+                    FROM (SELECT %(users)s::int[] AS u,
+                                 floor(random() * cardinality(%(users)s::int[]))::int AS s,
+                                 %(now)s - random() * %(days)s * interval '1 day' AS t,
+                                 (1 + floor(random() * 1000)) / 100 AS a,
+                                 random() < 0.01 AS annulled
+                          FROM generate_series(1, %(count)s)) AS x
+                    ''', dict(params, count=int(len(users) * days / 30 * options['transfers'])))
+            self.stdout.write('{} transfers ({:.1f} s)'.format(
+                count, time.monotonic() - start))
+
+            # Set the money according to the transactions; users with debts
+            # charge the missing amount
+            balance = '''
+                SELECT u.id,
+                       (SELECT coalesce(sum(amount), 0) FROM {charge}
+                        WHERE user_id = u.id AND NOT annulled)
+                       - (SELECT coalesce(sum(price), 0) FROM {purchase}
+                          WHERE user_id = u.id AND NOT annulled)
+                       + (SELECT coalesce(sum(amount), 0) FROM {transfer}
+                          WHERE receiver_id = u.id AND NOT annulled)
+                       - (SELECT coalesce(sum(amount), 0) FROM {transfer}
+                          WHERE sender_id = u.id AND NOT annulled) AS money
+                FROM {userdata} AS u
+                WHERE u.id = ANY(%(users)s)
+            '''
+            self.execute_sql('''
+                INSERT INTO {charge} (user_id, time_stamp, amount, annulled, comment)
+                SELECT id, %(now)s - interval '1 day', ceil(-money / 10) * 10 + 10, false, 'Ausgleich'
+                FROM (''' + balance + ''') AS x
+                WHERE money < 0
+                ''', params)
+            self.execute_sql('''
+                UPDATE {userdata} AS u SET money = x.money,
+                                           last_mail = %(now)s - interval '30 days'
+                FROM (''' + balance + ''') AS x
+                WHERE u.id = x.id
+                ''', params)
+
+            call_command('rebuildpurchasecounts', stdout=self.stdout)
+            call_command('rebuildledger', stdout=self.stdout)
+
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+        self.stdout.write('done ({:.1f} s)'.format(time.monotonic() - start))
@@ -0,0 +1,119 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import random
+import threading
+import time
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connection
+
+import store.backend as backend
+import store.config as config
+import store.exceptions as exceptions
+import store.models as models
+import store.retry as retry
+from store.management.commands.benchmark import percentile
+
+
+OPERATIONS = ('transfer', 'purchase')
+
+
+class Command(BaseCommand):
+    help = 'Measure the throughput of concurrent transfers (between few ' \
+           'users, also in opposite directions) and purchases of these ' \
+           'users. Run it against a seeded database (see the "seed" ' \
+           'command), it charges the users and books transactions.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=8,
+                            help='number of concurrent clients')
+        parser.add_argument('--seconds', type=float, default=10,
+                            help='duration of the run')
+        parser.add_argument('--users', type=int, default=4,
+                            help='number of users sending and receiving money')
+        parser.add_argument('--serializable', action='store_true',
+                            help='run the transactions at SERIALIZABLE (see '
+                                 'MONEY_READ_COMMITTED) for comparison')
+        parser.add_argument('--seed', type=int, default=0,
+                            help='seed for the random number generator')
+
+    def client(self, rng, users, products, deadline, results):
+        """
+        Run random operations until the deadline and record them in results
+        (operation -> list of (outcome, latency)).
+        """
+
+        try:
+            while time.monotonic() < deadline:
+                operation = rng.choice(OPERATIONS)
+                start = time.perf_counter()
+                try:
+                    if operation == 'transfer':
+                        sender, receiver = rng.sample(users, 2)
+                        backend.TransferLogic.transfer(
+                                sender['id'], receiver['ident'],
+                                models.UserIdentifier.RFID, Decimal('0.01'))
+                    else:
+                        backend.PurchaseLogic.purchase(
+                                rng.choice(users)['id'], rng.choice(products),
+                                models.ProductIdentifier.BARCODE)
+                    outcome = 'ok'
+                except exceptions.UserNotEnoughMoney:
+                    outcome = 'rejected'
+                except OperationalError:
+                    # Retries exhausted
+                    outcome = 'failed'
+                results[operation].append((outcome, time.perf_counter() - start))
+        finally:
+            connection.close()
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+
+        users = [{'id': x.user_id, 'ident': x.ident} for x in
+                 models.UserIdentifier.objects
+                    .filter(ident_type=models.UserIdentifier.RFID)
+                    .order_by('user_id')[:options['users']]]
+        products = list(models.ProductIdentifier.objects
+                .filter(ident_type=models.ProductIdentifier.BARCODE)
+                .values_list('ident', flat=True))
+        if len(users) < 2 or not products:
+            raise CommandError('not enough users or products, seed the database first')
+
+        # Enough money so purchases aren't rejected
+        for user in users:
+            backend.ChargeLogic.charge(user['id'], Decimal(1000))
+
+        if options['serializable']:
+            config.MONEY_READ_COMMITTED = False
+
+        before = retry.stats()
+        results = {x: [] for x in OPERATIONS}
+        deadline = time.monotonic() + options['seconds']
+        threads = [threading.Thread(target=self.client,
+                                    args=(random.Random(rng.random()), users,
+                                          products, deadline, results))
+                   for _ in range(options['threads'])]
+        for x in threads:
+            x.start()
+        for x in threads:
+            x.join()
+        after = retry.stats()
+
+        total = 0
+        for operation in OPERATIONS:
+            x = results[operation]
+            ok = sum(1 for outcome, _ in x if outcome == 'ok')
+            failed = sum(1 for outcome, _ in x if outcome == 'failed')
+            latencies = sorted(latency for _, latency in x)
+            retries = after.get(operation, {}).get('retries', 0) \
+                    - before.get(operation, {}).get('retries', 0)
+            total += ok
+            self.stdout.write('{:10} {:8.1f} ops/s  p50 {:7.1f} ms  '
+                              'p95 {:7.1f} ms  {:5} retries  {} failed'.format(
+                                  operation, ok / options['seconds'],
+                                  percentile(latencies, 50) * 1000 if latencies else 0,
+                                  percentile(latencies, 95) * 1000 if latencies else 0,
+                                  retries, failed))
+        self.stdout.write('{:10} {:8.1f} ops/s'.format('total', total / options['seconds']))
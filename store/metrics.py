@@ -0,0 +1,388 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# Metrics (request latency, queries, mails, retries, caches) in the Prometheus
+# text format. Each process records its metrics in memory and a background
+# thread periodically writes them to a file of this process in METRICS_DIR.
+# /metrics sums up the files of all processes (WSGI workers, mail worker).
+# It merges the files of exited processes into EXITED so counters never
+# decrease while the directory doesn't grow with recycled workers; clear the
+# directory when (re)starting the service. The processes are identified by
+# their pid, so all of them must run on the same host. Gauges are measured by
+# the process serving /metrics.
+
+import atexit
+import bisect
+import fcntl
+import json
+import os
+import tempfile
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from django.db import connection
+
+import store.config as config
+import store.retry as retry
+
+
+PREFIX = 'kaffeekasse_'
+# Sum of the metrics of all exited processes in METRICS_DIR
+EXITED = 'exited.json'
+# Held while reading or merging the files in METRICS_DIR
+LOCK = 'lock'
+
+Labels = Tuple[Tuple[str, str], ...]
+
+_lock = threading.Lock()
+# Name -> labels -> value
+_counters: Dict[str, Dict[Labels, float]] = {}
+# Name -> labels -> count per bucket (not cumulative, the last one is +Inf)
+# followed by the sum of the observed values
+_histograms: Dict[str, Dict[Labels, List[float]]] = {}
+# Name -> upper bounds of the buckets
+_buckets: Dict[str, List[float]] = {}
+# Name -> function returning the current value (None: no value)
+_gauges: Dict[str, Callable[[], Optional[float]]] = {}
+
+# Process which started the writer thread and the file it writes to
+_writer_pid: Optional[int] = None
+_path: Optional[str] = None
+
+
+def _reset() -> None:
+    """
+    Forget the metrics inherited from the parent process, they are already
+    counted by it.
+    """
+
+    global _lock, _counters, _histograms, _writer_pid, _path
+    # Another thread might have held the lock while forking
+    _lock = threading.Lock()
+    _counters = {}
+    _histograms = {}
+    _writer_pid = None
+    _path = None
+
+os.register_at_fork(after_in_child=_reset)
+
+
+def inc(name: str, value: float = 1, **labels: str) -> None:
+    """
+    Increment the counter name (without "_total") with the given labels.
+    """
+
+    key = tuple(sorted(labels.items()))
+    with _lock:
+        x = _counters.setdefault(name, {})
+        x[key] = x.get(key, 0) + value
+    _start_writer()
+
+
+def observe(name: str, value: float, buckets: List[float], **labels: str) -> None:
+    """
+    Record the value in the histogram name with the given labels.
+    """
+
+    key = tuple(sorted(labels.items()))
+    with _lock:
+        _buckets[name] = buckets
+        x = _histograms.setdefault(name, {}).get(key)
+        if x is None:
+            x = _histograms[name][key] = [0] * (len(buckets) + 1) + [0.0]
+        x[bisect.bisect_left(buckets, value)] += 1
+        x[-1] += value
+    _start_writer()
+
+
+def gauge(name: str, func: Callable[[], Optional[float]]) -> None:
+    """
+    Register the gauge name whose value is returned by func.
+    """
+
+    _gauges[name] = func
+
+
+def snapshot() -> dict:
+    """
+    Return the metrics of this process (including the statistics of the
+    retried transactions and the caches) as JSON serializable dict.
+    """
+
+    import store.cache as cache
+
+    with _lock:
+        counters = {name: [[list(k), v] for k, v in x.items()]
+                    for name, x in _counters.items()}
+        histograms = {name: {'buckets': _buckets[name],
+                             'series': [[list(k), list(v)] for k, v in x.items()]}
+                      for name, x in _histograms.items()}
+
+    for name, key in (('serialization_calls', 'calls'),
+                      ('serialization_retries', 'retries'),
+                      ('serialization_failures', 'failures'),
+                      ('serialization_retry_wait_seconds', 'wait')):
+        counters[name] = [[[['operation', operation]], x[key]]
+                          for operation, x in retry.stats().items()]
+
+    counters['cache_hits'] = []
+    counters['cache_misses'] = []
+    for name, x in (('user_identifiers', cache.user_identifiers),
+                    ('product_identifiers', cache.product_identifiers),
+                    ('transfer_targets', cache.transfer_targets)):
+        stats = x.stats()
+        counters['cache_hits'].append([[['cache', name]], stats['hits']])
+        counters['cache_misses'].append([[['cache', name]], stats['misses']])
+
+    return {'counters': counters, 'histograms': histograms}
+
+
+def write() -> None:
+    """
+    Write the metrics of this process to its file in METRICS_DIR.
+    """
+
+    if _path is None:
+        return
+    _write_json(_path, snapshot())
+
+
+def _write_json(path: str, data: dict) -> None:
+    # Replace the file atomically so readers never see a partial file
+    fd, tmp = tempfile.mkstemp(dir=config.METRICS_DIR, suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+def _write_loop() -> None:
+    while True:
+        time.sleep(config.METRICS_WRITE_INTERVAL_S)
+        write()
+
+
+def _start_writer() -> None:
+    global _writer_pid, _path
+
+    if config.METRICS_DIR is None or _writer_pid == os.getpid():
+        return
+    with _lock:
+        if _writer_pid == os.getpid():
+            return
+        _writer_pid = os.getpid()
+        # Unique even if the pid is reused later
+        _path = os.path.join(config.METRICS_DIR, '{}-{}.json'
+                             .format(_writer_pid, time.time_ns()))
+
+    threading.Thread(target=_write_loop, name='metrics', daemon=True).start()
+    # Don't lose the last metrics of short-lived processes (e.g. commands)
+    atexit.register(write)
+
+
+def _exited(name: str) -> bool:
+    """
+    Return whether the process which wrote the file name has exited.
+    """
+
+    try:
+        os.kill(int(name.split('-')[0]), 0)
+    except ProcessLookupError:
+        return True
+    except (ValueError, PermissionError):
+        pass
+    return False
+
+
+def _read_json(path: str) -> Optional[dict]:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def _merge_exited(names: List[str]) -> None:
+    """
+    Add the files (of METRICS_DIR) of exited processes to EXITED and delete
+    them.
+    """
+
+    exited_path = os.path.join(config.METRICS_DIR, EXITED)
+    exited = _read_json(exited_path) or {'counters': {}, 'histograms': {}}
+    merged = exited.get('merged', [])
+    # Already added but not deleted (e.g. crash in between)
+    for x in merged:
+        if x in names:
+            os.unlink(os.path.join(config.METRICS_DIR, x))
+
+    names = [x for x in names if x != EXITED and x not in merged and _exited(x)]
+    if not names:
+        return
+    paths = [os.path.join(config.METRICS_DIR, x) for x in names]
+    exited = _snapshot(*_sum([exited] + [x for x in map(_read_json, paths)
+                                         if x is not None]))
+    exited['merged'] = names
+    _write_json(exited_path, exited)
+    for x in paths:
+        os.unlink(x)
+
+
+def collect() -> List[dict]:
+    """
+    Return the snapshots of all processes.
+    """
+
+    result = [snapshot()]
+    if config.METRICS_DIR is None:
+        return result
+
+    with open(os.path.join(config.METRICS_DIR, LOCK), 'a') as lock:
+        # Concurrent requests would merge the same files twice or miss them
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        _merge_exited([x for x in os.listdir(config.METRICS_DIR) if x.endswith('.json')])
+        for name in os.listdir(config.METRICS_DIR):
+            path = os.path.join(config.METRICS_DIR, name)
+            # This process' file might be outdated, its snapshot is used
+            # instead
+            if not name.endswith('.json') or path == _path:
+                continue
+            x = _read_json(path)
+            if x is not None:
+                result.append(x)
+    return result
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\')
+                                                    .replace('"', '\\"')
+                                                    .replace('\n', '\\n'))
+                          for k, v in labels) + '}'
+
+
+def _sum(snapshots: List[dict]) -> Tuple[Dict[str, Dict[Labels, float]],
+                                          Dict[str, Dict[Labels, List[float]]],
+                                          Dict[str, List[float]]]:
+    """
+    Return the summed up counters, histograms and their buckets of the
+    snapshots.
+    """
+
+    counters: Dict[str, Dict[Labels, float]] = {}
+    histograms: Dict[str, Dict[Labels, List[float]]] = {}
+    buckets: Dict[str, List[float]] = {}
+    for x in snapshots:
+        for name, series in x['counters'].items():
+            y = counters.setdefault(name, {})
+            for labels, value in series:
+                key = tuple(tuple(l) for l in labels)
+                y[key] = y.get(key, 0) + value
+        for name, histogram in x['histograms'].items():
+            y = histograms.setdefault(name, {})
+            # Changed buckets (e.g. different configurations) can't be summed
+            if buckets.setdefault(name, histogram['buckets']) != histogram['buckets']:
+                continue
+            for labels, values in histogram['series']:
+                key = tuple(tuple(l) for l in labels)
+                if key not in y:
+                    y[key] = [0] * len(values)
+                y[key] = [a + b for a, b in zip(y[key], values)]
+    return counters, histograms, buckets
+
+
+def _snapshot(counters: Dict[str, Dict[Labels, float]],
+              histograms: Dict[str, Dict[Labels, List[float]]],
+              buckets: Dict[str, List[float]]) -> dict:
+    """
+    Return the result of _sum() as snapshot.
+    """
+
+    return {
+        'counters': {name: [[list(k), v] for k, v in x.items()]
+                     for name, x in counters.items()},
+        'histograms': {name: {'buckets': buckets[name],
+                              'series': [[list(k), v] for k, v in x.items()]}
+                       for name, x in histograms.items()},
+    }
+
+
+def render() -> str:
+    """
+    Return the summed up metrics of all processes in the Prometheus text
+    format.
+    """
+
+    counters, histograms, buckets = _sum(collect())
+
+    lines = []
+    for name in sorted(_gauges):
+        value = _gauges[name]()
+        if value is not None:
+            lines.append('# TYPE {}{} gauge'.format(PREFIX, name))
+            lines.append('{}{} {}'.format(PREFIX, name, value))
+    for name in sorted(counters):
+        lines.append('# TYPE {}{}_total counter'.format(PREFIX, name))
+        for labels, value in sorted(counters[name].items()):
+            lines.append('{}{}_total{} {}'.format(
+                PREFIX, name, _format_labels(labels), value))
+    for name in sorted(histograms):
+        lines.append('# TYPE {}{} histogram'.format(PREFIX, name))
+        for labels, values in sorted(histograms[name].items()):
+            count = 0
+            for bound, value in zip(buckets[name] + ['+Inf'], values):
+                count += value
+                lines.append('{}{}_bucket{} {}'.format(
+                    PREFIX, name, _format_labels(labels + (('le', bound),)), count))
+            lines.append('{}{}_sum{} {}'.format(
+                PREFIX, name, _format_labels(labels), values[-1]))
+            lines.append('{}{}_count{} {}'.format(
+                PREFIX, name, _format_labels(labels), count))
+    return '\n'.join(lines) + '\n'
+
+
+class QueryTimer:
+    """
+    Database execute wrapper which counts the queries and their duration.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.duration += time.perf_counter() - start
+
+
+class MetricsMiddleware:
+    """
+    Record latency, number of queries and query time of each request per
+    view.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        queries = QueryTimer()
+        start = time.perf_counter()
+        with connection.execute_wrapper(queries):
+            response = self.get_response(request)
+        duration = time.perf_counter() - start
+
+        match = request.resolver_match
+        view = match.view_name if match is not None else 'unknown'
+        inc('requests', view=view, status=str(response.status_code))
+        observe('request_duration_seconds', duration,
+                config.METRICS_DURATION_BUCKETS_S, view=view)
+        observe('request_queries', queries.count,
+                config.METRICS_QUERY_BUCKETS, view=view)
+        observe('request_query_duration_seconds', queries.duration,
+                config.METRICS_DURATION_BUCKETS_S, view=view)
+        return response
@@ -3,26 +3,18 @@
 import django.core.validators as validators
 import django.contrib.auth.models
 import django.dispatch
-from django.contrib.sessions.models import Session
 from django.db import models
-from django.db.models.signals import pre_save, post_save
+from django.db.models.signals import post_save
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
 import store.config as config
 
 
-# Per default, Django does not execute validators when saving a model. Enforce
-# this to guarantee the code cannot break these assumptions.
-#
-# Used, among others, to prevent negative money for users!
-def validate_model(sender, instance, raw, **kwargs):
-    if not raw:
-        # TODO: Find a better solution for this workaround
-        # Prevent the following error "django.core.exceptions.ValidationError:
-        # {'session_key': ['Session with this Session key already exists.']}"
-        if not isinstance(instance, Session):
-            instance.full_clean()
-pre_save.connect(validate_model)
+# Django doesn't execute validators when saving a model, they only run in
+# forms (e.g. the admin). Invariants which the code must never break (like
+# negative money for users) are therefore enforced by check constraints in the
+# database as well.
 
 
 class UserData(models.Model):
@@ -36,6 +28,10 @@ class UserData(models.Model):
     shown_on_login_screen = models.BooleanField(default=True)
     last_mail = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        constraints = [models.CheckConstraint(name='money_min_limit',
+            check=models.Q(money__gte=config.MONEY_MIN_LIMIT))]
+
     def __str__(self):
         return '{} ({} {} {})'.format(self.auth.username, self.idm,
                 self.auth.first_name, self.auth.last_name)
@@ -78,23 +74,55 @@ class UserIdentifier(models.Model):
 
 
 class UnknownUserIdentifier(models.Model):
+    """
+    Identifier of a failed login, e.g. of a new RFID card which can then be
+    assigned to its user. Repeated scans only update the existing entry.
+    """
+
     ident_type = models.IntegerField(choices=UserIdentifier.choices)
     ident = models.TextField()
-    time_stamp = models.DateTimeField(auto_now=True)
+    first_seen = models.DateTimeField(default=timezone.now)
+    last_seen = models.DateTimeField(default=timezone.now)
+    hits = models.IntegerField(default=1)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(name='unique_unknown_ident',
+            fields=['ident_type', 'ident'])]
+        # For expiring old entries
+        indexes = [models.Index(name='unknown_ident_last_seen',
+            fields=['last_seen'])]
 
 
 class Product(models.Model):
     name = models.TextField()
     category = models.ForeignKey('productcategory', on_delete=models.CASCADE,
             related_name='products')
+    # Without the pending StockChanges, see ProductLogic.annotateStock()
     stock = models.IntegerField(default=0)
     price = models.DecimalField(max_digits=6, decimal_places=2,
             validators=[validators.MinValueValidator(0)])
 
+    class Meta:
+        constraints = [models.CheckConstraint(name='product_price_positive',
+            check=models.Q(price__gte=0))]
+
     def __str__(self):
         return self.name
 
 
+class StockChange(models.Model):
+    """
+    Change of a product's stock which is not yet added to Product.stock.
+    Purchases only insert these rows instead of updating the product's row
+    which would serialize all purchases of the same product. The compactstock
+    command periodically adds them to the stock.
+    """
+
+    product = models.ForeignKey('product', on_delete=models.CASCADE,
+            related_name='+')
+    amount = models.IntegerField()
+
+
 class ProductCategory(models.Model):
     SNACK = 231740
     GETRAENK = 231741
@@ -135,8 +163,14 @@ class ProductIdentifier(models.Model):
             fields=['ident_type', 'ident'])]
 
 
+# The transactions are usually queried per user and time. The (user,
+# time_stamp) indexes also serve queries by user only, therefore the foreign
+# keys don't need separate indexes. The time_stamp indexes serve the monthly
+# bills of all users and the date hierarchy of the admin lists.
+
 class Charge(models.Model):
-    user = models.ForeignKey(UserData, on_delete=models.CASCADE)
+    user = models.ForeignKey(UserData, on_delete=models.CASCADE,
+            db_index=False)
     time_stamp = models.DateTimeField(auto_now=True)
     amount = models.DecimalField(max_digits=6, decimal_places=2)
     annulled = models.BooleanField(default=False)
@@ -145,9 +179,17 @@ class Charge(models.Model):
                               related_name='charge_admin')
     comment = models.TextField(blank=True)
 
+    class Meta:
+        indexes = [
+            models.Index(name='charge_user_time_stamp',
+                fields=['user', 'time_stamp']),
+            models.Index(name='charge_time_stamp', fields=['time_stamp']),
+        ]
+
 
 class Purchase(models.Model):
-    user = models.ForeignKey(UserData, on_delete=models.CASCADE)
+    user = models.ForeignKey(UserData, on_delete=models.CASCADE,
+            db_index=False)
     product = models.ForeignKey('product', on_delete=models.SET_NULL,
             null=True)
     time_stamp = models.DateTimeField(auto_now=True)
@@ -155,12 +197,37 @@ class Purchase(models.Model):
             validators=[validators.MinValueValidator(0)])
     annulled = models.BooleanField(default=False)
 
+    class Meta:
+        constraints = [models.CheckConstraint(name='purchase_price_positive',
+            check=models.Q(price__gte=0))]
+        indexes = [
+            models.Index(name='purchase_user_time_stamp',
+                fields=['user', 'time_stamp']),
+            models.Index(name='purchase_time_stamp', fields=['time_stamp']),
+        ]
+
+
+class PurchaseCount(models.Model):
+    """
+    Number of non-annulled purchases of a product per user and day. Updated
+    together with each purchase, used for 'Häufig gekauft'.
+    """
+
+    user = models.ForeignKey(UserData, on_delete=models.CASCADE)
+    product = models.ForeignKey('product', on_delete=models.CASCADE)
+    day = models.DateField()
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(name='unique_purchase_count',
+            fields=['user', 'day', 'product'])]
+
 
 class Transfer(models.Model):
     sender = models.ForeignKey(UserData, on_delete=models.SET_NULL, null=True,
-            related_name='sender')
+            related_name='sender', db_index=False)
     receiver  = models.ForeignKey(UserData, on_delete=models.SET_NULL,
-            null=True, related_name='receiver')
+            null=True, related_name='receiver', db_index=False)
     time_stamp = models.DateTimeField(auto_now=True)
     amount = models.DecimalField(max_digits=6, decimal_places=2,
             validators=[validators.MinValueValidator(0)])
@@ -170,4 +237,179 @@ class Transfer(models.Model):
                               related_name='transfer_admin')
     comment = models.TextField(blank=True)
     class Meta:
-        constraints = [models.CheckConstraint(name='different_users', check=~models.Q(sender=models.F('receiver')))]
+        constraints = [
+            models.CheckConstraint(name='different_users', check=~models.Q(sender=models.F('receiver'))),
+            models.CheckConstraint(name='transfer_amount_positive', check=models.Q(amount__gte=0)),
+        ]
+        indexes = [
+            models.Index(name='transfer_sender_time_stamp',
+                fields=['sender', 'time_stamp']),
+            models.Index(name='transfer_receiver_time_stamp',
+                fields=['receiver', 'time_stamp']),
+            models.Index(name='transfer_time_stamp', fields=['time_stamp']),
+        ]
+
+
+class LedgerEntry(models.Model):
+    """
+    Append-only record of every change of a user's money (including
+    annulments) with the user's balance after the change. Written together
+    with the money (see UserLogic.changeMoney()).
+    """
+
+    # Random numbers for easy grepping
+    PURCHASE = 604450
+    PURCHASE_ANNULMENT = 604451
+    CHARGE = 604452
+    CHARGE_ANNULMENT = 604453
+    TRANSFER = 604454
+    TRANSFER_ANNULMENT = 604455
+    # Repair of the money, see the "reconcile" management command
+    CORRECTION = 604456
+
+    choices = [
+        (PURCHASE, 'Purchase'),
+        (PURCHASE_ANNULMENT, 'Purchase annulment'),
+        (CHARGE, 'Charge'),
+        (CHARGE_ANNULMENT, 'Charge annulment'),
+        (TRANSFER, 'Transfer'),
+        (TRANSFER_ANNULMENT, 'Transfer annulment'),
+        (CORRECTION, 'Correction'),
+    ]
+
+    user = models.ForeignKey(UserData, on_delete=models.CASCADE,
+            db_index=False)
+    time_stamp = models.DateTimeField(default=timezone.now)
+    kind = models.IntegerField(choices=choices)
+    amount = models.DecimalField(max_digits=6, decimal_places=2)
+    balance = models.DecimalField(max_digits=6, decimal_places=2)
+    # The booked transaction, depending on kind. The ledger is never queried
+    # by these, no indexes required. No constraints because archived
+    # transactions are moved to the archive tables with the same id.
+    purchase = models.ForeignKey(Purchase, on_delete=models.DO_NOTHING,
+            null=True, blank=True, db_index=False, db_constraint=False,
+            related_name='+')
+    charge = models.ForeignKey(Charge, on_delete=models.DO_NOTHING,
+            null=True, blank=True, db_index=False, db_constraint=False,
+            related_name='+')
+    transfer = models.ForeignKey(Transfer, on_delete=models.DO_NOTHING,
+            null=True, blank=True, db_index=False, db_constraint=False,
+            related_name='+')
+
+    class Meta:
+        # For the history of a user (keyset pagination) and the balance at a
+        # given time; time_stamp for the admin's date hierarchy
+        indexes = [
+            models.Index(name='ledger_user_time_stamp',
+                fields=['user', 'time_stamp', 'id']),
+            models.Index(name='ledger_time_stamp', fields=['time_stamp']),
+        ]
+
+
+# Transactions older than the archive horizon (which can't be annulled or
+# billed anymore) are moved to the following tables by the "archive"
+# management command. They keep their ids.
+
+class ArchivedCharge(models.Model):
+    id = models.IntegerField(primary_key=True)
+    user = models.ForeignKey(UserData, on_delete=models.CASCADE,
+            db_index=False, related_name='+')
+    time_stamp = models.DateTimeField()
+    amount = models.DecimalField(max_digits=6, decimal_places=2)
+    annulled = models.BooleanField(default=False)
+    admin = models.ForeignKey(UserData, on_delete=models.SET_NULL,
+                              null=True, blank=True, related_name='+')
+    comment = models.TextField(blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(name='archived_charge_user_time',
+                fields=['user', 'time_stamp']),
+            models.Index(name='archived_charge_time', fields=['time_stamp']),
+        ]
+
+
+class ArchivedPurchase(models.Model):
+    id = models.IntegerField(primary_key=True)
+    user = models.ForeignKey(UserData, on_delete=models.CASCADE,
+            db_index=False, related_name='+')
+    product = models.ForeignKey('product', on_delete=models.SET_NULL,
+            null=True, related_name='+')
+    time_stamp = models.DateTimeField()
+    price = models.DecimalField(max_digits=6, decimal_places=2)
+    annulled = models.BooleanField(default=False)
+
+    class Meta:
+        indexes = [
+            models.Index(name='archived_purchase_user_time',
+                fields=['user', 'time_stamp']),
+            models.Index(name='archived_purchase_time', fields=['time_stamp']),
+        ]
+
+
+class ArchivedTransfer(models.Model):
+    id = models.IntegerField(primary_key=True)
+    sender = models.ForeignKey(UserData, on_delete=models.SET_NULL, null=True,
+            db_index=False, related_name='+')
+    receiver = models.ForeignKey(UserData, on_delete=models.SET_NULL,
+            null=True, db_index=False, related_name='+')
+    time_stamp = models.DateTimeField()
+    amount = models.DecimalField(max_digits=6, decimal_places=2)
+    annulled = models.BooleanField(default=False)
+    admin = models.ForeignKey(UserData, on_delete=models.SET_NULL,
+                              null=True, blank=True, related_name='+')
+    comment = models.TextField(blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(name='archived_transfer_sender',
+                fields=['sender', 'time_stamp']),
+            models.Index(name='archived_transfer_receiver',
+                fields=['receiver', 'time_stamp']),
+            models.Index(name='archived_transfer_time', fields=['time_stamp']),
+        ]
+
+
+class BalanceCheckpoint(models.Model):
+    """
+    Sum of all archived (non-annulled) transactions of a user, i.e. the
+    user's money at time_stamp.
+    """
+
+    user = models.OneToOneField(UserData, on_delete=models.CASCADE)
+    # All transactions before this time are archived
+    time_stamp = models.DateTimeField()
+    amount = models.DecimalField(max_digits=10, decimal_places=2)
+
+
+class OutgoingMail(models.Model):
+    """
+    Outbox for notification mails. Mails are written in the same transaction
+    as the notified event and sent by a separate worker (see the "mailworker"
+    management command).
+    """
+
+    # Random numbers for easy grepping
+    QUEUED = 418270
+    SENT = 418271
+    FAILED = 418272
+
+    choices = [
+        (QUEUED, 'Queued'),
+        (SENT, 'Sent'),
+        (FAILED, 'Failed'),
+    ]
+
+    recipient = models.TextField()
+    subject = models.TextField()
+    body = models.TextField()
+    state = models.IntegerField(choices=choices, default=QUEUED)
+    time_stamp = models.DateTimeField(auto_now_add=True)
+    # Number of failed attempts to send the mail
+    attempts = models.IntegerField(default=0)
+    next_attempt = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+
+    class Meta:
+        indexes = [models.Index(name='outgoing_mail_queue',
+            fields=['state', 'next_attempt'])]
@@ -1,15 +1,25 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 
+import logging
+import time
+from datetime import timedelta
 from typeguard import typechecked
 from typing import Optional, Iterable
 
-from django.db.models.query import QuerySet
+from django.db import transaction
+from django.utils import timezone
 
+from store import config
+from store import metrics
 from store import models
 
-from smtplib import SMTP
+from smtplib import SMTP, SMTPRecipientsRefused, SMTPSenderRefused, \
+        SMTPServerDisconnected
 from email.message import EmailMessage
 
+
+logger = logging.getLogger(__name__)
+
 class User:
     """
     Store all the information about a User required in notify
@@ -97,39 +107,31 @@ class Bill:
             self.sum   = purchase['sum']
 
     class Charge:
-        def __init__(self, charge: Charge):
-            self.count   = charge.count
-            self.comment = charge.comment
-            self.sum     = charge.sum
+        def __init__(self, charge: dict):
+            self.count   = charge['count']
+            self.comment = charge['comment']
+            self.sum     = charge['sum']
 
     class Outgoing:
-        def __init__(self, transfer: Transfer):
-            try:
-                self.receiver = transfer.receiver.auth.username
-            except AttributeError:
-                self.receiver = None
-
+        def __init__(self, transfer: dict):
+            self.receiver = transfer['receiver__auth__username']
             if self.receiver is None:
                 self.receiver = '/unknown/'
 
-            self.count = transfer.count
-            self.sum   = transfer.sum
+            self.count = transfer['count']
+            self.sum   = transfer['sum']
 
     class Incoming:
-        def __init__(self, transfer: Transfer):
-            try:
-                self.sender = transfer.sender.auth.username
-            except AttributeError:
-                self.sender = None
-
+        def __init__(self, transfer: dict):
+            self.sender = transfer['sender__auth__username']
             if self.sender is None:
                 self.sender = '/unknown/'
 
-            self.count = transfer.count
-            self.sum   = transfer.sum
+            self.count = transfer['count']
+            self.sum   = transfer['sum']
 
-    def __init__(self, user: models.UserData, subject: str, purchases: QuerySet, \
-                 charges: QuerySet, outgoing: QuerySet, incoming: QuerySet):
+    def __init__(self, user: models.UserData, subject: str, purchases: Iterable[dict], \
+                 charges: Iterable[dict], outgoing: Iterable[dict], incoming: Iterable[dict]):
         self.user = User(user)
         self.subject = subject
         self.purchases = [Bill.Purchase(x) for x in purchases]
@@ -138,6 +140,15 @@ class Bill:
         self.incoming  = [Bill.Incoming(x) for x in incoming]
 
     def execute(self):
+        mail = self.compose()
+        if mail is not None:
+            mail.save()
+
+    def compose(self) -> Optional[models.OutgoingMail]:
+        """
+        Return the (unsaved) mail or None if the user needs no bill.
+        """
+
         blocks = []
 
         if len(self.purchases):
@@ -176,16 +187,32 @@ class Bill:
         # Only send mails if...
         if len(blocks):
             # ... anything happend for the user
-            notify(self.user, self.subject, '\n\n'.join(blocks) + '\n')
+            return compose(self.user, self.subject, '\n\n'.join(blocks) + '\n')
         elif self.user.money < 0:
             # ... or the user is in debt
-            notify(self.user, self.subject, "")
+            return compose(self.user, self.subject, "")
+        return None
 
 
 def notify(user: User, subject: str, message: str, admin: Optional[models.UserData] = None) -> None:
     """
-    Send a notification to user
+    Send a notification to user. The mail is written to the outbox as part of
+    the current transaction and sent later by the mail worker.
+    """
+    mail = compose(user, subject, message, admin)
+    if mail is not None:
+        mail.save()
+
+
+def compose(user: User, subject: str, message: str, admin: Optional[models.UserData] = None) \
+        -> Optional[models.OutgoingMail]:
+    """
+    Return the (unsaved) notification mail to user or None if the user has
+    no mail address
     """
+    if not user.data.auth.email:
+        return None
+
     name = user.data.auth.first_name if user.data.auth.first_name else user.data.auth.username
     if len(message) and not message[-1] == '\n':
         message += '\n'
@@ -208,16 +235,110 @@ Deine Kaffeekasse 2020NT
 PS: Die Aktion wurde durchgeführt von {admin.auth.username}
 '''
 
-    msg = EmailMessage()
-    msg.set_content(body)
-    msg['To'] = user.data.auth.email
-    msg['From'] = 'i4kaffee@cs.fau.de'
-    msg['Subject'] = f'Kaffeekasse: {subject}'
-
-    try:
-        with SMTP('localhost') as smtp:
-            smtp.send_message(msg)
-    except Exception as e:
-        # only log the notification failure but do not abort
-        # the transaction with an exception
-        print(e)
+    return models.OutgoingMail(recipient=user.data.auth.email,
+                               subject=f'Kaffeekasse: {subject}',
+                               body=body)
+
+
+class Mailer:
+    """
+    Persistent SMTP connection which is reused for multiple mails.
+    """
+
+    def __init__(self, host: str = config.MAIL_SMTP_HOST):
+        self.host = host
+        self.smtp = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self) -> None:
+        if self.smtp is None:
+            return
+        try:
+            self.smtp.quit()
+        except Exception:
+            pass
+        self.smtp = None
+
+    def send(self, mail: models.OutgoingMail) -> None:
+        msg = EmailMessage()
+        msg.set_content(mail.body)
+        msg['To'] = mail.recipient
+        msg['From'] = config.MAIL_FROM
+        msg['Subject'] = mail.subject
+
+        start = time.perf_counter()
+        try:
+            try:
+                self._send(msg)
+            except SMTPServerDisconnected:
+                # The server closed the idle connection, reconnect once
+                self._send(msg)
+        except Exception:
+            metrics.inc('mails', result='failed')
+            raise
+        finally:
+            metrics.observe('smtp_send_duration_seconds', time.perf_counter() - start,
+                            config.METRICS_DURATION_BUCKETS_S)
+        metrics.inc('mails', result='sent')
+
+    def _send(self, msg: EmailMessage) -> None:
+        if self.smtp is None:
+            self.smtp = SMTP(self.host)
+        try:
+            self.smtp.send_message(msg)
+        except (SMTPRecipientsRefused, SMTPSenderRefused):
+            # Only this mail was refused, the connection is still usable
+            raise
+        except Exception:
+            self.close()
+            raise
+
+
+def send_queued_mails(mailer: Mailer, batch_size: int = config.MAIL_BATCH_SIZE) -> int:
+    """
+    Send up to batch_size queued mails from the outbox and return the number
+    of processed mails. Mails which couldn't be sent are retried later and
+    marked as failed after too many attempts. Multiple workers can run
+    concurrently, mails claimed by another worker are skipped.
+    """
+
+    # Claim the mails for MAIL_LEASE_S seconds instead of keeping them locked
+    # while talking to the SMTP server; if this worker dies they're sent by
+    # the next one after the lease expired
+    with transaction.atomic():
+        now = timezone.now()
+        mails = list(models.OutgoingMail.objects \
+                .select_for_update(skip_locked=True) \
+                .filter(state=models.OutgoingMail.QUEUED, next_attempt__lte=now) \
+                .order_by('id')[:batch_size])
+        models.OutgoingMail.objects \
+                .filter(id__in=[x.id for x in mails]) \
+                .update(next_attempt=now + timedelta(seconds=config.MAIL_LEASE_S))
+
+    for mail in mails:
+        try:
+            mailer.send(mail)
+        except Exception as e:
+            mail.attempts += 1
+            mail.last_error = str(e)
+            if mail.attempts >= config.MAIL_MAX_ATTEMPTS:
+                mail.state = models.OutgoingMail.FAILED
+                logger.error('mail %d to %s failed permanently: %s',
+                             mail.id, mail.recipient, e)
+            else:
+                delay = config.MAIL_RETRY_DELAY_S * 2 ** (mail.attempts - 1)
+                mail.next_attempt = timezone.now() + timedelta(seconds=delay)
+                logger.warning('mail %d to %s failed: %s',
+                               mail.id, mail.recipient, e)
+        else:
+            mail.state = models.OutgoingMail.SENT
+
+        # Stored right away, a failure later in the batch must not send this
+        # mail again
+        mail.save(update_fields=['state', 'attempts', 'next_attempt', 'last_error'])
+    return len(mails)
@@ -0,0 +1,145 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# Read-only queries (e.g. the lists of recent purchases) are sent to the read
+# replica REPLICA_DATABASE while it's in sync with the primary. Queries are
+# only sent to the replica inside readonly(), everything else (including
+# queries in transactions) stays on the primary. After a write request the
+# same browser reads from the primary for REPLICA_PIN_S seconds so it sees its
+# own changes.
+
+import contextlib
+import contextvars
+import logging
+import time
+from typing import Optional
+
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+
+import store.config as config
+import store.metrics as metrics
+
+
+# Marks browsers which recently sent a write request
+COOKIE = 'primary'
+
+logger = logging.getLogger(__name__)
+
+_readonly = contextvars.ContextVar('readonly', default=False)
+_pinned = contextvars.ContextVar('pinned', default=False)
+
+# Last measured lag in seconds (None: replica unavailable) and time of the
+# measurement
+_lag: Optional[float] = None
+_lag_time: Optional[float] = None
+
+
+@contextlib.contextmanager
+def readonly():
+    """
+    Send the queries in this block to the replica. Also usable as decorator
+    ("@readonly()").
+    """
+
+    token = _readonly.set(True)
+    try:
+        yield
+    finally:
+        _readonly.reset(token)
+
+
+def lag() -> Optional[float]:
+    """
+    Return the replication lag of the replica in seconds (measured at most
+    every REPLICA_LAG_CHECK_S seconds), None if it's not available.
+    """
+
+    global _lag, _lag_time
+
+    if _lag_time is not None and time.monotonic() - _lag_time < config.REPLICA_LAG_CHECK_S:
+        return _lag
+
+    try:
+        with connections[config.REPLICA_DATABASE].cursor() as cursor:
+            # A replica which doesn't receive WAL (e.g. the connection to the
+            # primary is down) has an unknown lag. Without new WAL (no writes
+            # on the primary) a streaming replica is in sync although the
+            # last replayed transaction is old.
+            cursor.execute('''
+                SELECT CASE WHEN NOT pg_is_in_recovery() THEN 0
+                            WHEN NOT EXISTS (SELECT 1 FROM pg_stat_wal_receiver
+                                             WHERE status = 'streaming') THEN NULL
+                            WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                            ELSE extract(epoch FROM now() - pg_last_xact_replay_timestamp())
+                       END
+                ''')
+            value = cursor.fetchone()[0]
+        _lag = float(value) if value is not None else None
+    except DatabaseError as e:
+        logger.warning('measuring the replica lag failed: %s', e)
+        metrics.inc('replica_errors')
+        _lag = None
+    _lag_time = time.monotonic()
+    return _lag
+
+
+def _use_replica() -> bool:
+    if config.REPLICA_DATABASE is None or not _readonly.get() or _pinned.get():
+        return False
+    # Keep the reads of a transaction consistent with its writes
+    if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+        return False
+    x = lag()
+    return x is not None and x <= config.REPLICA_MAX_LAG_S
+
+
+def _replica_lag_gauge() -> Optional[float]:
+    if config.REPLICA_DATABASE is None:
+        return None
+    return lag()
+
+metrics.gauge('replica_lag_seconds', _replica_lag_gauge)
+
+
+class ReplicaRouter:
+    """
+    Database router which sends reads in readonly() to the replica.
+    """
+
+    def db_for_read(self, model, **hints):
+        if _use_replica():
+            return config.REPLICA_DATABASE
+        return DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        # Also objects read from the replica are written to the primary
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Both databases contain the same data
+        return True
+
+    def allow_migrate(self, db, app_label, **hints):
+        return db != config.REPLICA_DATABASE
+
+
+class ReplicaMiddleware:
+    """
+    Pin the browser to the primary for REPLICA_PIN_S seconds after each write
+    request.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        write = request.method not in ('GET', 'HEAD', 'OPTIONS', 'TRACE')
+        token = _pinned.set(write or COOKIE in request.COOKIES)
+        try:
+            response = self.get_response(request)
+        finally:
+            _pinned.reset(token)
+
+        if write and config.REPLICA_DATABASE is not None:
+            response.set_cookie(COOKIE, '1', max_age=config.REPLICA_PIN_S,
+                                httponly=True, samesite='Lax')
+        return response
@@ -0,0 +1,129 @@
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# Run transactions and retry them if they fail because of concurrent
+# transactions. The database uses the SERIALIZABLE isolation level (see
+# DATABASES in settings.py) which aborts one of two conflicting transactions.
+# Transactions which lock the rows they depend on can run at READ COMMITTED
+# instead, where only deadlocks abort them.
+
+import logging
+import random
+import threading
+import time
+from typing import Callable, Dict, TypeVar
+
+from django.db import OperationalError, connection, transaction
+
+import store.config as config
+
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+# SQLSTATEs of errors which can be resolved by retrying the transaction
+# (serialization_failure and deadlock_detected)
+RETRYABLE_SQLSTATES = ('40001', '40P01')
+
+
+class Stats:
+    """
+    Contention statistics of one operation.
+    """
+
+    def __init__(self):
+        # Number of runs of the operation
+        self.calls = 0
+        # Number of retries after a serialization failure
+        self.retries = 0
+        # Number of runs which failed after exhausting all retries
+        self.failures = 0
+        # Total time in seconds spent waiting between retries
+        self.wait = 0.0
+
+    def as_dict(self) -> dict:
+        return {
+            'calls': self.calls,
+            'retries': self.retries,
+            'failures': self.failures,
+            'wait': self.wait,
+        }
+
+
+_stats_lock = threading.Lock()
+_stats: Dict[str, Stats] = {}
+
+
+def stats() -> Dict[str, dict]:
+    """
+    Return the contention statistics of all operations run in this process.
+    """
+
+    with _stats_lock:
+        return {name: x.as_dict() for name, x in _stats.items()}
+
+
+def _record(name: str, **kwargs) -> None:
+    with _stats_lock:
+        x = _stats.setdefault(name, Stats())
+        for key, value in kwargs.items():
+            setattr(x, key, getattr(x, key) + value)
+
+
+def is_retryable(error: Exception) -> bool:
+    cause = error.__cause__
+    # psycopg2 uses "pgcode", psycopg 3 "sqlstate"
+    code = getattr(cause, 'pgcode', None) or getattr(cause, 'sqlstate', None)
+    return code in RETRYABLE_SQLSTATES
+
+
+def atomic(name: str, func: Callable[[], T], read_committed: bool = False) -> T:
+    """
+    Run func in a transaction and return its result. If the transaction is
+    aborted because of a conflict with a concurrent transaction it's retried
+    (with randomized exponential backoff) until the configured number of
+    retries or the time budget is exhausted.
+
+    func must not have side effects outside of the database as it might be
+    called multiple times. name identifies the operation in the statistics.
+    With read_committed (and MONEY_READ_COMMITTED enabled) func runs at READ
+    COMMITTED; it must lock the rows it depends on (in a fixed order).
+    """
+
+    _record(name, calls=1)
+
+    # Only the outermost transaction can be retried (and change the isolation
+    # level); a failure inside a nested block aborts the outer transaction as
+    # well
+    if connection.in_atomic_block:
+        with transaction.atomic():
+            return func()
+
+    budget = config.SERIALIZATION_RETRY_BUDGET_MS / 1000
+    deadline = time.monotonic() + budget
+    attempt = 0
+    while True:
+        try:
+            with transaction.atomic():
+                if read_committed and config.MONEY_READ_COMMITTED:
+                    with connection.cursor() as cursor:
+                        cursor.execute('SET TRANSACTION ISOLATION LEVEL READ COMMITTED')
+                return func()
+        except OperationalError as e:
+            if not is_retryable(e):
+                raise
+
+            # Full jitter, see
+            # https://aws.amazon.com/blogs/architecture/exponential-backoff-and-jitter/
+            backoff = config.SERIALIZATION_RETRY_BACKOFF_MS / 1000 * 2 ** attempt
+            delay = random.uniform(0, backoff)
+            if attempt >= config.SERIALIZATION_RETRIES \
+                    or time.monotonic() + delay > deadline:
+                _record(name, failures=1)
+                logger.warning('%s: giving up after %d retries: %s',
+                               name, attempt, e)
+                raise
+
+            attempt += 1
+            _record(name, retries=1, wait=delay)
+            time.sleep(delay)
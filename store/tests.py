@@ -1,5 +1,461 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 
-from django.test import TestCase
+import io
+import json
+import os
+import subprocess
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+import django.contrib.auth.models
+from django.contrib import admin
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import Count, Sum
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+import store.backend as backend
+import store.cache as cache
+import store.config as config
+import store.invalidation as invalidation
+import store.metrics as metrics
+import store.models as models
+import store.retry as retry
+
+
+# Maximum number of queries per admin changelist page, independent of the
+# number of shown rows (session, user, count, list, date hierarchy, etc.)
+ADMIN_QUERY_BUDGET = 12
+
+# Tables which grow with every transaction and must never be read completely;
+# the users, products, etc. are small enough
+LARGE_TABLES = [x._meta.db_table for x in (
+    models.ArchivedCharge,
+    models.ArchivedPurchase,
+    models.ArchivedTransfer,
+    models.Charge,
+    models.LedgerEntry,
+    models.Purchase,
+    models.PurchaseCount,
+    models.Transfer,
+    models.UnknownUserIdentifier,
+)]
+
+
+def seq_scans(plan):
+    """
+    Return the names of all large relations read with a sequential scan in
+    the given plan (as returned by EXPLAIN (FORMAT JSON)).
+    """
+
+    result = []
+    if plan['Node Type'] == 'Seq Scan' and plan['Relation Name'] in LARGE_TABLES:
+        result.append(plan['Relation Name'])
+    for x in plan.get('Plans', []):
+        result.extend(seq_scans(x))
+    return result
+
+
+def tearDownModule():
+    # The listener's connection would prevent dropping the test database
+    invalidation.stop()
+
+
+def wait_for(condition, timeout=10):
+    """
+    Wait until condition() is true, fail after timeout seconds.
+    """
+
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError('timed out waiting for {}'.format(condition))
+        time.sleep(0.05)
+
+
+class SeededTestCase(TestCase):
+    """
+    A few users with two months of transactions, the older ones archived.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        call_command('seed', users=5, categories=2, products=5, years=0.2,
+                     stdout=io.StringIO())
+        call_command('archive', days=40, stdout=io.StringIO())
+
+        cls.user = models.UserData.objects.order_by('pk').first()
+        models.UnknownUserIdentifier.objects.create(
+                ident_type=models.UserIdentifier.RFID, ident='unknown')
+        models.OutgoingMail.objects.create(recipient='seed0@example.org',
+                                           subject='Test', body='Test')
+
+
+class AdminQueryTests(SeededTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.admin = django.contrib.auth.models.User.objects.create_superuser(
+                'admin', 'admin@example.org', 'admin')
+
+    def setUp(self):
+        self.client.force_login(self.admin)
+
+    def changelist(self, model_admin):
+        """
+        Return the URL of the changelist page of the model, after the
+        redirect to the default month.
+        """
+
+        opts = model_admin.model._meta
+        url = reverse('admin:{}_{}_changelist'.format(opts.app_label, opts.model_name))
+        response = self.client.get(url)
+        if response.status_code == 302:
+            url += response['Location']
+        return url
+
+    def test_changelists_within_query_budget(self):
+        for model, model_admin in admin.site._registry.items():
+            if model._meta.app_label not in ('store', 'auth'):
+                continue
+
+            url = self.changelist(model_admin)
+            with self.subTest(url=url):
+                with CaptureQueriesContext(connection) as queries:
+                    response = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+                # Also the archive starts at a month with transactions
+                self.assertGreater(response.context['cl'].result_count, 0)
+                self.assertLessEqual(len(queries), ADMIN_QUERY_BUDGET)
+
+            if model_admin.search_fields:
+                url += ('&' if '?' in url else '?') + 'q=seed1'
+                with self.subTest(url=url):
+                    with CaptureQueriesContext(connection) as queries:
+                        response = self.client.get(url)
+                    self.assertEqual(response.status_code, 200)
+                    self.assertLessEqual(len(queries), ADMIN_QUERY_BUDGET)
+
+    def test_transaction_changelist_starts_at_current_month(self):
+        url = reverse('admin:store_purchase_changelist')
+        now = timezone.localtime()
+        response = self.client.get(url)
+        self.assertRedirects(response, url + '?dated=1&time_stamp__year={}&time_stamp__month={}'
+                                             .format(now.year, now.month),
+                             fetch_redirect_response=False)
+
+    def test_archive_changelist_starts_at_newest_month(self):
+        url = reverse('admin:store_archivedpurchase_changelist')
+        response = self.client.get(url, follow=True)
+        newest = timezone.localtime(models.ArchivedPurchase.objects
+                .latest('time_stamp').time_stamp)
+        self.assertEqual(response.context['cl'].params['time_stamp__month'],
+                         str(newest.month))
+        self.assertGreater(response.context['cl'].result_count, 0)
+
+    def test_all_dates(self):
+        url = reverse('admin:store_purchase_changelist')
+        response = self.client.get(self.changelist(admin.site._registry[models.Purchase]))
+        # The "All dates" link of the year keeps the marker
+        year = response.context['cl'].get_query_string(
+                {'time_stamp__month': None}, ['time_stamp__month'])
+        response = self.client.get(url + year)
+        self.assertContains(response, 'class="date-back"')
+        all_dates = response.context['cl'].get_query_string({}, ['time_stamp__'])
+        self.assertEqual(all_dates, '?dated=1')
+
+        response = self.client.get(url + all_dates)
+        self.assertEqual(response.status_code, 200)
+        cl = response.context['cl']
+        self.assertEqual(cl.result_count, models.Purchase.objects.count())
+        self.assertFalse(cl.queryset.query.where)
+
+
+class ProductAdminTests(TestCase):
+    def setUp(self):
+        admin = django.contrib.auth.models.User.objects.create_superuser(
+                'admin', 'admin@example.org', 'admin')
+        self.client.force_login(admin)
+        category = models.ProductCategory.objects.create(
+                toplevel=models.ProductCategory.GETRAENK, sublevel='Kaffee')
+        self.product = models.Product.objects.create(
+                name='Kaffee', category=category, stock=10, price=Decimal('0.30'))
+        backend.ProductLogic.changeStock(self.product.id, -2)
+        self.url = reverse('admin:store_product_change', args=[self.product.id])
+
+    def current_stock(self):
+        return backend.ProductLogic.annotateStock(
+                models.Product.objects.filter(pk=self.product.id)).get().current_stock
+
+    def edit(self, **data):
+        """
+        Load the change form, purchase the product meanwhile and submit the
+        form with the given changes.
+        """
+
+        form = self.client.get(self.url).context['adminform'].form
+        self.assertEqual(form['stock'].value(), self.current_stock())
+        backend.ProductLogic.changeStock(self.product.id, -1)
+
+        post = {x: form[x].value()
+                for x in ('name', 'category', 'price', 'stock', 'shown_stock')}
+        post.update(data)
+        response = self.client.post(self.url, post)
+        self.assertEqual(response.status_code, 302)
+
+    def test_other_changes_keep_stock(self):
+        self.edit(name='Espresso')
+        self.assertEqual(self.current_stock(), 7)
+        self.assertEqual(models.Product.objects.get(pk=self.product.id).name, 'Espresso')
+
+    def test_stock_change_keeps_concurrent_purchases(self):
+        # The shown stock is 8, one was bought before saving
+        self.edit(stock=20)
+        self.assertEqual(self.current_stock(), 19)
+
+
+class MostBoughtTests(TestCase):
+    def test_window(self):
+        user = django.contrib.auth.models.User.objects.create_user('alice').userdata
+        category = models.ProductCategory.objects.create(
+                toplevel=models.ProductCategory.GETRAENK, sublevel='Kaffee')
+        today = timezone.localdate()
+        for name, days in (('inside', config.T_MOST_BOUGHT_PRODUCTS_D - 1),
+                           ('outside', config.T_MOST_BOUGHT_PRODUCTS_D)):
+            product = models.Product.objects.create(
+                    name=name, category=category, price=Decimal('0.30'))
+            models.PurchaseCount.objects.create(user=user, product=product,
+                    day=today - timedelta(days=days), count=1)
+
+        self.assertEqual([x['product__name'] for x in
+                          backend.ProductLogic.getMostBoughtProductsList(user.id)],
+                         ['inside'])
+
+
+class BuyManyTests(TestCase):
+    def setUp(self):
+        auth = django.contrib.auth.models.User.objects.create_user('alice')
+        self.client.force_login(auth)
+        backend.ChargeLogic.charge(auth.userdata.id, Decimal(100))
+        category = models.ProductCategory.objects.create(
+                toplevel=models.ProductCategory.GETRAENK, sublevel='Kaffee')
+        product = models.Product.objects.create(
+                name='Kaffee', category=category, price=Decimal('0.30'))
+        models.ProductIdentifier.objects.create(product=product,
+                ident_type=models.ProductIdentifier.BARCODE, ident='1234')
+
+    def post(self, count, ident_type=models.ProductIdentifier.BARCODE):
+        return self.client.post(reverse('buy_many'), {
+            'ident': ['1234'] * count,
+            'ident_type': [ident_type] * count,
+        })
+
+    def test_purchase(self):
+        response = self.post(3)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()['purchases']), 3)
+
+    def test_malformed_ident_type(self):
+        self.assertEqual(self.post(1, ident_type='x').status_code, 400)
+
+    def test_too_many_products(self):
+        response = self.post(config.N_PURCHASE_MANY_PRODUCTS + 1)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('error', response.json())
+        self.assertFalse(models.Purchase.objects.exists())
+
+
+class MetricsTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        patcher = mock.patch.object(config, 'METRICS_DIR', directory.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def write(self, pid, value, start=1):
+        with open(os.path.join(config.METRICS_DIR, '{}-{}.json'.format(pid, start)), 'w') as f:
+            json.dump({'counters': {'test': [[[['view', 'x']], value]]},
+                       'histograms': {}}, f)
+
+    def test_exited_processes_are_merged(self):
+        exited = subprocess.Popen(['true'])
+        exited.wait()
+        self.write(exited.pid, 2)
+        self.write(os.getppid(), 3)
+
+        for _ in range(2):
+            self.assertIn('kaffeekasse_test_total{view="x"} 5', metrics.render())
+        self.assertEqual(sorted(os.listdir(config.METRICS_DIR)),
+                         sorted([metrics.EXITED, metrics.LOCK,
+                                 '{}-1.json'.format(os.getppid())]))
+
+        # Later exits are added
+        self.write(exited.pid, 1, start=2)
+        self.assertIn('kaffeekasse_test_total{view="x"} 6', metrics.render())
+
+
+class QueryPlanTests(SeededTestCase):
+    def hot_queries(self, user_id):
+        """
+        Return the SQL and parameters of the queries which must not scan
+        whole tables.
+        """
+
+        with CaptureQueriesContext(connection) as queries:
+            backend.ProductLogic.getMostBoughtProductsList(user_id)
+            backend.ProductLogic.getLastBoughtProductsList(user_id)
+            backend.ChargeLogic.getLastChargesList(user_id)
+            backend.TransferLogic.getLastTransfers(user_id)
+            backend.TransferLogic.getFrequentTransferTargets(user_id)
+            entries = backend.LedgerLogic.getEntries(user_id)
+            last = entries[-1]
+            backend.LedgerLogic.getEntries(user_id, before=(last['time_stamp'], last['id']))
+            backend.LedgerLogic.getBalance(user_id, timezone.now() - timedelta(days=365))
+
+        result = [(x['sql'], None) for x in queries.captured_queries]
+
+        now = timezone.now()
+        since = now - timedelta(days=31)
+
+        # Expiry of unknown identifiers
+        result.append(models.UnknownUserIdentifier.objects
+                .filter(last_seen__lt=now - timedelta(days=1)).query.sql_with_params())
+
+        # Monthly bills (see scripts/send-mails.py)
+        result.append(models.Purchase.objects
+                .filter(time_stamp__gte=since, time_stamp__lt=now, annulled=False)
+                .values('user_id', 'product_id')
+                .annotate(count=Count('id'), sum=Sum('price')).query.sql_with_params())
+        result.append(models.Charge.objects
+                .filter(time_stamp__gte=since, time_stamp__lt=now, annulled=False)
+                .values('user_id', 'comment')
+                .annotate(count=Count('id'), sum=Sum('amount')).query.sql_with_params())
+        result.append(models.Transfer.objects
+                .filter(time_stamp__gte=since, time_stamp__lt=now, annulled=False)
+                .values('sender_id', 'receiver_id')
+                .annotate(count=Count('id'), sum=Sum('amount')).query.sql_with_params())
+        return result
+
+    def test_hot_queries_can_use_indexes(self):
+        """
+        Sequential scans are disabled, PostgreSQL then only plans one if no
+        index matches the query. With the few rows of the test database the
+        planner would prefer sequential scans, so this doesn't show that it
+        chooses the indexes on real data.
+        """
+
+        with connection.cursor() as cursor:
+            cursor.execute('SET LOCAL enable_seqscan = off')
+
+            for sql, params in self.hot_queries(self.user.id):
+                with self.subTest(sql=sql):
+                    cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+                    plan = cursor.fetchone()[0]
+                    if isinstance(plan, str):
+                        plan = json.loads(plan)
+                    self.assertEqual(seq_scans(plan[0]['Plan']), [])
+
+
+class InvalidationTests(TransactionTestCase):
+    # NOTIFY is only delivered on commit
+    def setUp(self):
+        # Notice the lost connection and stop() quickly
+        patcher = mock.patch.object(config, 'CACHE_POLL_INTERVAL_S', 0.5)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        invalidation.start()
+        # The listener drops everything cached before it listens
+        self.assertTrue(invalidation._listening.wait(10))
+        cache.transfer_targets.clear()
+        generation = cache.transfer_targets.generation
+        cache.transfer_targets.put(1, ['one'], generation)
+        cache.transfer_targets.put(2, ['two'], generation)
+
+    def tearDown(self):
+        invalidation.stop()
+
+    def test_notification_drops_entry(self):
+        # Published by another process, this process ignores its own
+        with connection.cursor() as cursor:
+            cursor.execute('''
+                SELECT pg_notify(%s, concat_ws(' ', 'other', nextval(%s), %s, %s))
+                ''', [invalidation.CHANNEL, invalidation.SEQUENCE, 'transfer_targets', 1])
+
+        wait_for(lambda: cache.transfer_targets.stats()['size'] < 2)
+        self.assertIsNone(cache.transfer_targets.get(1))
+        self.assertEqual(cache.transfer_targets.get(2), ['two'])
+
+    def test_polling_after_connection_loss(self):
+        with connection.cursor() as cursor:
+            cursor.execute('''
+                SELECT pg_terminate_backend(pid) FROM pg_stat_activity
+                WHERE datname = current_database() AND pid <> pg_backend_pid()
+                  AND backend_type = 'client backend'
+                ''')
+            self.assertEqual(cursor.rowcount, 1)
+            # Not notified, only the version changes
+            cursor.execute('SELECT nextval(%s)', [invalidation.SEQUENCE])
+
+        wait_for(lambda: cache.transfer_targets.stats()['size'] == 0)
+        # And it listens again
+        self.assertTrue(invalidation._listening.wait(10))
+
+
+class ConcurrentTransferTests(TransactionTestCase):
+    # The transfers must commit to conflict with each other
+    def setUp(self):
+        self.users = []
+        for name in ('alice', 'bob'):
+            user = django.contrib.auth.models.User.objects.create_user(name).userdata
+            models.UserIdentifier.objects.create(user=user,
+                    ident_type=models.UserIdentifier.RFID, ident=name)
+            backend.ChargeLogic.charge(user.id, Decimal(10))
+            self.users.append(user)
+
+    def transfers(self, sender, receiver, count, errors):
+        try:
+            for _ in range(count):
+                backend.TransferLogic.transfer(sender.id, receiver.auth.username,
+                        models.UserIdentifier.RFID, Decimal('0.01'))
+        except Exception as e:
+            errors.append(e)
+        finally:
+            connection.close()
+
+    def test_opposite_transfers(self):
+        alice, bob = self.users
+        errors = []
+        before = retry.stats().get('transfer', {})
+
+        # Half of the threads in each direction; lockUsers() locks both users
+        # in the same order so they can't deadlock
+        threads = [threading.Thread(target=self.transfers,
+                                    args=(alice, bob, 25, errors) if i % 2 == 0
+                                         else (bob, alice, 25, errors))
+                   for i in range(8)]
+        for x in threads:
+            x.start()
+        for x in threads:
+            x.join()
+
+        after = retry.stats()['transfer']
+        self.assertEqual(errors, [])
+        # Deadlocks would be retried
+        self.assertEqual(after['retries'] - before.get('retries', 0), 0)
+        self.assertEqual(after['failures'] - before.get('failures', 0), 0)
+
+        self.assertEqual(models.Transfer.objects.count(), 200)
+        for user in self.users:
+            user.refresh_from_db()
+            self.assertEqual(user.money, Decimal(10))
+        # Raises CommandError if the money doesn't match the transactions
+        call_command('reconcile', stdout=io.StringIO())
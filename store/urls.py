@@ -8,11 +8,15 @@ from . import views
 urlpatterns = [
     path('', views.index, name='index'),
     path('buy', views.buy, name='buy'),
+    path('buy_many', views.buy_many, name='buy_many'),
+    path('catalog.json', views.catalog, name='catalog'),
     path('buy_revert', views.buy_revert, name='buy_revert'),
     path('transfer', views.transfer, name='transfer'),
     path('transfer_revert', views.transfer_revert, name='transfer_revert'),
     path('charge', views.charge, name='charge'),
     path('charge_revert', views.charge_revert, name='charge_revert'),
+    path('user_search', views.user_search, name='user_search'),
+    path('metrics', views.metrics_view, name='metrics'),
 
     # Auth
     path('login', views.login, name='login'),
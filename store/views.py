@@ -1,17 +1,20 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 
-from decimal import Decimal, InvalidOperation
-
 import django.contrib.auth
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.views import redirect_to_login
+from django.core.exceptions import ValidationError
 from django.http import HttpResponse, HttpResponseRedirect, JsonResponse
 from django.shortcuts import render, reverse
+from django.utils.crypto import constant_time_compare
+from django.utils.cache import get_conditional_response, patch_cache_control
 from django.views.decorators.csrf import csrf_protect
 from django.views.decorators.http import require_http_methods
 
 import store.backend as backend
 import store.config as config
+import store.exceptions as exceptions
+import store.metrics as metrics
 import store.models as models
 from store.exceptions import ClientMessageException
 
@@ -29,6 +32,18 @@ def permit_direct_login(request):
     return True
 
 
+def clean_amount(model, value):
+    """
+    Return the POSTed amount for the model validated by its field (digits,
+    decimal places); models are not validated when saving them.
+    """
+
+    amount = model._meta.get_field('amount').clean(value, None)
+    if amount <= 0:
+        raise exceptions.NegativeMoneyAmount()
+    return amount
+
+
 @require_http_methods(['GET'])
 def index(request):
     """
@@ -63,16 +78,16 @@ def buy(request):
             'logout_barcodes': [ "48047005" ],
             'most_bought': backend.ProductLogic.getMostBoughtProductsList(user_id),
             'recently_bought': backend.ProductLogic.getLastBoughtProductsList(user_id),
+            # The products are loaded from the catalog view
             'categories': [{
                 'name': 'Getränke',
                 'id': 'drinks',
-                'products': backend.ProductLogic.getDrinks(),
+                'toplevel': models.ProductCategory.GETRAENK,
             }, {
                 'name': 'Nahrung',
                 'id': 'candies',
-                'products': backend.ProductLogic.getCandies(),
+                'toplevel': models.ProductCategory.SNACK,
             }],
-            'products': models.Product.objects.all(),
             'ident_types': models.ProductIdentifier,
             'config': config,
         })
@@ -98,6 +113,58 @@ def buy(request):
     assert False
 
 
+@login_required(login_url='index')
+@require_http_methods(['POST'])
+@csrf_protect
+def buy_many(request):
+    """
+    POST: Purchase multiple products at once (all or none) and return the
+    product ids and the purchase ids as JsonResponse
+    """
+
+    user_id = request.user.userdata.id
+
+    idents = request.POST.getlist('ident')
+    try:
+        ident_types = [int(x) for x in request.POST.getlist('ident_type')]
+    except ValueError:
+        return HttpResponse(status=400)
+    if len(idents) != len(ident_types):
+        return HttpResponse(status=400)
+
+    try:
+        purchases = backend.PurchaseLogic.purchaseMany(user_id,
+                list(zip(idents, ident_types)))
+    except ClientMessageException as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    return JsonResponse({
+        'purchases': [{
+            'purchase_id': purchase_id,
+            'product_id': product_id,
+        } for purchase_id, product_id in purchases],
+    })
+
+
+@login_required(login_url='index')
+@require_http_methods(['GET'])
+def catalog(request):
+    """
+    GET: Return all categories and products as JSON. The response carries an
+    ETag, clients revalidate their copy with If-None-Match.
+    """
+
+    catalog = backend.ProductLogic.getCatalog()
+
+    response = get_conditional_response(request, etag=catalog.etag)
+    if response is None:
+        response = HttpResponse(catalog.json, content_type='application/json')
+    response['ETag'] = catalog.etag
+    # Cache it but always revalidate
+    patch_cache_control(response, no_cache=True)
+    return response
+
+
 @login_required(login_url='index')
 @require_http_methods(['POST'])
 @csrf_protect
@@ -137,10 +204,11 @@ def charge(request):
         })
 
     if request.method == 'POST':
-        amount = request.POST.get('amount')
         try:
-            amount = Decimal(amount)
-        except InvalidOperation as e:
+            amount = clean_amount(models.Charge, request.POST.get('amount'))
+        except ValidationError as e:
+            return JsonResponse({'error': ' '.join(e.messages)}, status=400)
+        except ClientMessageException as e:
             return JsonResponse({'error': str(e)}, status=400)
         try:
             charge_id = backend.ChargeLogic.charge(user_id, amount)
@@ -190,15 +258,21 @@ def transfer(request):
         receiver_id = request.POST.get('receiver_ident')
         receiver_ident_type = int(request.POST.get('ident_type'))
         try:
-            amount = Decimal(request.POST.get('amount'))
-        except InvalidOperation as e:
+            amount = clean_amount(models.Transfer, request.POST.get('amount'))
+        except ValidationError as e:
+            return JsonResponse({'error': ' '.join(e.messages)}, status=400)
+        except ClientMessageException as e:
             return JsonResponse({'error': str(e)}, status=400)
         try:
             transfer_tuple = backend.TransferLogic.transfer(
                 user_id, receiver_id, receiver_ident_type, amount)
         except ClientMessageException as e:
             return JsonResponse({'error': str(e)}, status=400)
-        return JsonResponse({'transfer_id': transfer_tuple[0], 'receiver_id': transfer_tuple[1]})
+        return JsonResponse({
+            'transfer_id': transfer_tuple[0],
+            'receiver_id': transfer_tuple[1],
+            'receiver_username': transfer_tuple[2],
+        })
 
     assert False
 
@@ -218,6 +292,42 @@ def transfer_revert(request):
     return HttpResponse(status=200)
 
 
+@require_http_methods(['GET'])
+def user_search(request):
+    """
+    GET: Return the users matching the query as JsonResponse. Logged in users
+    search transfer receivers, otherwise the users of the login screen are
+    searched.
+    """
+
+    if request.user.is_authenticated:
+        user_id = request.user.userdata.id
+    elif permit_direct_login(request):
+        user_id = None
+    else:
+        return HttpResponse(status=403)
+
+    return JsonResponse({
+        'users': backend.UserLogic.searchUsers(request.GET.get('q', ''), user_id),
+    })
+
+
+@require_http_methods(['GET'])
+def metrics_view(request):
+    """
+    GET: Return the metrics of all processes in the Prometheus text format.
+    """
+
+    if config.METRICS_TOKEN is None:
+        return HttpResponse(status=404)
+    if not constant_time_compare(request.headers.get('Authorization', ''),
+                                 'Bearer ' + config.METRICS_TOKEN):
+        return HttpResponse(status=403)
+
+    return HttpResponse(metrics.render(),
+                        content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 # Authentication
 
 @require_http_methods(['POST'])